@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+Grid evaluation of the AEM-RBF model for maps of heads and stream function.
+
+Current implementations:
+
+    - evaluate_grid: tiled evaluation of heads and stream function on a regular grid,
+      optionally distributed over a process pool. The model is sent once to each worker
+      and the workers write the tiles directly into shared-memory output arrays
+      (no pickling of results).
+    - stream_grid: out-of-core evaluation in blocks of rows, written to memory-mapped .npy
+      files, for grids that do not fit comfortably in memory.
+    - precision_error: error estimate of the reduced-precision (float32) evaluation with
+      respect to float64, to choose the precision of each job.
+    - WellLayers: cached contribution of each well (for unit discharge) to the grid, for
+      interactive sessions: adding, removing, moving or re-rating a well only recomputes the
+      layer of that well, and the field is the sum of the layers.
+
+All grid evaluators take a dtype argument: numpy.float64 (default) or numpy.float32, which
+halves memory and bandwidth (see Model.calc_omega and kernels.omega_reduced).
+
+The grid is defined by the x and y coordinate vectors; results have shape (len(yvec), len(xvec)),
+as from numpy.meshgrid(xvec, yvec).
+"""
+import os
+import pickle
+import numpy as np
+import kernels
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+
+def tiles(ny, nx, tile = 256):
+    """
+    Splits a (ny, nx) grid into tiles.
+
+    Returns
+    -------
+    list of (row0, row1, col0, col1) index ranges.
+
+    """
+    return [(r, min(r + tile, ny), c, min(c + tile, nx))
+            for r in range(0, ny, tile) for c in range(0, nx, tile)]
+
+
+def evaluate_tile(model, xvec, yvec, h, psi, tile, dtype = np.float64):
+    """
+    Evaluates heads and stream function of one tile (row0, row1, col0, col1) into the arrays h and psi.
+    """
+    r0, r1, c0, c1 = tile
+    omega, head = model.calc_omega(xvec[np.newaxis, c0:c1], yvec[r0:r1, np.newaxis], head = True, dtype = dtype)
+    h[r0:r1, c0:c1] = head
+    psi[r0:r1, c0:c1] = omega.imag
+
+
+'''
+process pool workers
+'''
+
+_worker = {}
+
+def _init_worker(model_bytes, xvec, yvec, shm_name, shape, dtype):
+    # Runs once per worker process: loads the model and attaches the shared output
+    shm = shared_memory.SharedMemory(name = shm_name)
+    out = np.ndarray((2,) + shape, dtype = dtype, buffer = shm.buf)
+    _worker.update(model = pickle.loads(model_bytes), xvec = xvec, yvec = yvec, shm = shm, out = out, dtype = dtype)
+
+def _run_tile(tile):
+    w = _worker
+    evaluate_tile(w['model'], w['xvec'], w['yvec'], w['out'][0], w['out'][1], tile, dtype = w['dtype'])
+    return tile
+
+
+def evaluate_grid(model, xvec, yvec, tile = 256, workers = None, dtype = np.float64):
+    """
+    Evaluates heads and stream function of the model on the grid defined by xvec and yvec.
+
+    Parameters
+    ----------
+    model: AEM-RBF model
+    xvec, yvec: 1d arrays with the grid coordinates.
+    tile: size (rows and columns) of the tiles evaluated at once. Limits the temporary memory.
+    workers: number of worker processes. None or 1 evaluates the tiles in this process,
+             0 uses os.cpu_count() workers.
+             When using the numba backend (already parallel) keep workers None or
+             limit the numba threads (NUMBA_NUM_THREADS).
+    dtype: numpy.float64 or numpy.float32 (reduced precision, see precision_error).
+
+    Returns
+    -------
+    h, psi: numpy arrays (len(yvec), len(xvec), dtype) with the heads and the stream function.
+
+    """
+    xvec = np.asarray(xvec, dtype = float)
+    yvec = np.asarray(yvec, dtype = float)
+    shape = (yvec.shape[0], xvec.shape[0])
+    grid_tiles = tiles(*shape, tile = tile)
+    if workers == 0:
+        workers = os.cpu_count()
+    dtype = np.dtype(dtype)
+    if (workers is None) or (workers == 1) or (len(grid_tiles) == 1):
+        h, psi = np.empty(shape, dtype = dtype), np.empty(shape, dtype = dtype)
+        for t in grid_tiles:
+            evaluate_tile(model, xvec, yvec, h, psi, t, dtype = dtype)
+        return h, psi
+
+    shm = shared_memory.SharedMemory(create = True, size = 2*shape[0]*shape[1]*dtype.itemsize)
+    try:
+        out = np.ndarray((2,) + shape, dtype = dtype, buffer = shm.buf)
+        with ProcessPoolExecutor(max_workers = workers, initializer = _init_worker,
+                                 initargs = (pickle.dumps(model), xvec, yvec, shm.name, shape, dtype)) as pool:
+            list(pool.map(_run_tile, grid_tiles))
+        h, psi = out[0].copy(), out[1].copy()
+        del out
+    finally:
+        shm.close()
+        shm.unlink()
+    return h, psi
+
+
+def stream_grid(model, xvec, yvec, h_path, psi_path, block_rows = 64, dtype = np.float64):
+    """
+    Evaluates heads and stream function of the model on the grid defined by xvec and yvec,
+    block of rows by block of rows, writing the results to memory-mapped .npy files.
+    Only one block of rows is kept in memory. This is a generator: the grid is evaluated
+    as it is iterated.
+    
+        for row0, row1 in stream_grid(model, xvec, yvec, 'h.npy', 'psi.npy'):
+            print('{:.0%}'.format(row1/len(yvec)))
+        h = np.load('h.npy', mmap_mode = 'r')
+
+    Parameters
+    ----------
+    model: AEM-RBF model
+    xvec, yvec: 1d arrays with the grid coordinates.
+    h_path, psi_path: paths of the output .npy files (shape (len(yvec), len(xvec)))
+    block_rows: number of grid rows evaluated at once.
+    dtype: numpy.float64 or numpy.float32 (reduced precision, see precision_error).
+
+    Yields
+    -------
+    (row0, row1): range of rows already written to the files.
+
+    """
+    xvec = np.asarray(xvec, dtype = float)
+    yvec = np.asarray(yvec, dtype = float)
+    shape = (yvec.shape[0], xvec.shape[0])
+    h = np.lib.format.open_memmap(h_path, mode = 'w+', dtype = dtype, shape = shape)
+    psi = np.lib.format.open_memmap(psi_path, mode = 'w+', dtype = dtype, shape = shape)
+    try:
+        for r0 in range(0, shape[0], block_rows):
+            r1 = min(r0 + block_rows, shape[0])
+            evaluate_tile(model, xvec, yvec, h, psi, (r0, r1, 0, shape[1]), dtype = dtype)
+            h.flush()
+            psi.flush()
+            yield r0, r1
+    finally:
+        del h, psi
+
+
+def precision_error(model, xvec, yvec, dtype = np.float32, n_sample = 10000):
+    """
+    Estimates the error of the grid evaluation in reduced precision with respect to float64,
+    from a regular subsample of (about) n_sample grid nodes.
+
+    Returns
+    -------
+    dict with the maximum and root mean square absolute error of the heads
+    ('head_max', 'head_rms') and of the stream function ('psi_max', 'psi_rms').
+    Nodes with undefined heads (dry) are ignored.
+
+    """
+    xvec = np.asarray(xvec, dtype = float)
+    yvec = np.asarray(yvec, dtype = float)
+    step = max(1, int(np.sqrt(xvec.shape[0]*yvec.shape[0]/n_sample)))
+    xs = xvec[np.newaxis, ::step]
+    ys = yvec[::step, np.newaxis]
+    omega, h = model.calc_omega(xs, ys, head = True)
+    omega_r, h_r = model.calc_omega(xs, ys, head = True, dtype = dtype)
+    dh = np.abs(h - h_r)
+    dpsi = np.abs(omega.imag - omega_r.imag)
+    return {'head_max': np.nanmax(dh), 'head_rms': np.sqrt(np.nanmean(dh**2)),
+            'psi_max': np.nanmax(dpsi), 'psi_rms': np.sqrt(np.nanmean(dpsi**2))}
+
+
+class WellLayers:
+    """
+    Cached per-well layers of a grid for incremental evaluation of a model.
+
+    Each well has a layer with its potential and stream function (with its image) for unit
+    discharge on the grid, and its potential at the reference location of the model. The field is
+    the sum of the layers times the discharge rates, plus the baseflow and the reference constant.
+    update compares the model wells with the cached layers (by wellid) and only computes the
+    layers of the new wells and of the wells that were moved (or whose image changed, e.g. with
+    the clogging factor); removed wells are dropped. Changes of the discharge rates or the baseflow
+    only need the sum.
+
+        layers = WellLayers(model, xvec, yvec)
+        h, psi = layers.evaluate()
+        well.x += 10
+        h, psi = layers.evaluate() # only the layer of well is recomputed
+
+    Inputs:
+    --------------------------
+        model: AEM-RBF model (not an ensemble)
+        xvec, yvec: 1d arrays with the grid coordinates.
+
+    Memory: 2 float64 grids per well.
+    """
+    def __init__(self, model, xvec, yvec):
+        self.model = model
+        self.xvec = np.asarray(xvec, dtype = float)
+        self.yvec = np.asarray(yvec, dtype = float)
+        self.shape = (self.yvec.shape[0], self.xvec.shape[0])
+        self.layers = {} # wellid: (geometry, phi layer, psi layer, phi at the reference location)
+        self.n_computed = 0 # number of layers computed (since creation)
+
+    def _layer(self, xw, yw, rw, xi):
+        m = self.model
+        omega = kernels.omega_pairs(self.xvec[np.newaxis, :], self.yvec[:, np.newaxis], xw, yw, rw, xi)[..., 0]/(2*np.pi)
+        ref = kernels.omega_pairs(m.x, m.y, xw, yw, rw, xi)[0].real/(2*np.pi)
+        self.n_computed += 1
+        return np.ascontiguousarray(omega.real), np.ascontiguousarray(omega.imag), ref
+
+    def update(self):
+        """
+        Synchronizes the layers with the model wells.
+
+        Returns
+        -------
+        number of layers computed.
+
+        """
+        m = self.model
+        if m.ensemble_shape != ():
+            raise ValueError("WellLayers do not support ensemble models")
+        if m.elements:
+            raise ValueError("WellLayers do not support models with elements other than wells")
+        if m.strip is not None:
+            raise ValueError("WellLayers do not support strip aquifers")
+        xw, yw, Q, rw, xi = m.well_arrays()
+        wellid = m.wells.wellid
+        ids = set(wellid.tolist())
+        for removed in [i for i in self.layers if i not in ids]:
+            del self.layers[removed]
+        computed = self.n_computed
+        for j, i in enumerate(wellid.tolist()):
+            xi_j = None if xi is None else xi[j] # (None: no image river)
+            geometry = (xw[j], yw[j], rw[j], xi_j, m.x, m.y)
+            if (i not in self.layers) or (self.layers[i][0] != geometry):
+                self.layers[i] = (geometry,) + self._layer(xw[j], yw[j], rw[j], xi_j)
+        return self.n_computed - computed
+
+    def evaluate(self, dtype = np.float64):
+        """
+        Updates the layers and sums them with the current discharge rates and baseflow.
+
+        Returns
+        -------
+        h, psi: numpy arrays (len(yvec), len(xvec), dtype) with the heads and the stream function.
+
+        """
+        self.update()
+        m = self.model
+        phi = np.full(self.shape, m.phi_c + m.Qo_x*m.x) # reference constant without the wells
+        phi -= m.Qo_x*self.xvec[np.newaxis, :]
+        psi = np.empty(self.shape)
+        psi[:] = -m.Qo_x*self.yvec[:, np.newaxis]
+        phi_ref = 0.0 # potential of the wells at the reference location
+        for i, Q in zip(m.wells.wellid.tolist(), m.wells.Q.tolist()):
+            _, phi_layer, psi_layer, ref = self.layers[i]
+            phi += Q*phi_layer
+            psi += Q*psi_layer
+            phi_ref += Q*ref
+        phi -= phi_ref
+        return m.head_from_phi(phi).astype(dtype, copy = False), psi.astype(dtype, copy = False)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+Influence (unit response) matrices of the AEM-RBF model.
+
+The discharge potential and the stream function are linear in the discharge rate of each well
+and in the baseflow, including the reference constant phi0 (phi0 = phi_c minus the potential of
+the wells and baseflow at the reference location). With the unit responses at a set of points,
+computed once, the potential for any vector of rates is a matrix product:
+
+    phi(points) = phi_c + [Q, Qo_x] @ G_phi        G_phi[j] = unit response of well j (last row: baseflow)
+    psi(points) = [Q, Qo_x] @ G_psi
+
+where the rows of G_phi are the unit responses at the points minus the unit response at the
+reference location. A whole pumping time series (rates with shape times x wells) is evaluated
+at once, with results of shape times x points.
+
+The matrices depend on the well locations, the river (image wells, clogging factor p) and the
+reference location, not on the rates: they are rebuilt with InfluenceMatrix.from_model when the
+geometry changes. They can be saved to a directory of .npy files and loaded as read-only
+memory maps, e.g. by worker processes (InfluenceMatrix.load(path, mmap_mode = 'r')).
+
+read_wel_flows reads pumping schedules in the format of the MODFLOW 6 well observations
+(wel_flows.csv: time, BASE_FLOW, PUMP_WEL).
+"""
+import json
+import os
+import numpy as np
+import pandas as pd
+
+import kernels
+
+
+class InfluenceMatrix:
+    """
+    Unit responses of the potential and stream function of a model at fixed points.
+
+    Attributes
+    --------------------
+    x, y : point coordinates (flattened)
+    shape : shape of the points (results have shape (times,) + shape, or shape for a single vector of rates)
+    G_phi, G_psi : unit response matrices ((wells + 1) x points), last row: baseflow Qo_x
+    wellid : wellid of each row
+    Q, Qo_x : discharge rates and baseflow of the model the matrices were built from
+    k, H, phi_c : aquifer parameters for the heads
+    """
+    def __init__(self, x, y, shape, G_phi, G_psi, wellid, Q, Qo_x, k, H, phi_c):
+        self.x = x
+        self.y = y
+        self.shape = tuple(shape)
+        self.G_phi = G_phi
+        self.G_psi = G_psi
+        self.wellid = wellid
+        self.Q = Q
+        self.Qo_x = Qo_x
+        self.k = k
+        self.H = H
+        self.phi_c = phi_c
+
+    @classmethod
+    def from_model(cls, model, x, y, block = 4096):
+        """
+        Computes the unit responses of the model wells and baseflow at the points (x, y).
+
+        Parameters
+        ----------
+        model: AEM-RBF model (not an ensemble)
+        x, y: coordinates of the points, floats or numpy arrays of any (broadcastable) shape.
+        block: number of points evaluated at once (limits the temporary memory).
+
+        Returns
+        -------
+        InfluenceMatrix
+
+        """
+        if model.ensemble_shape != ():
+            raise ValueError("Influence matrices do not support ensemble models")
+        if model.elements:
+            raise ValueError("Influence matrices do not support models with elements other than wells")
+        if model.strip is not None:
+            raise ValueError("Influence matrices do not support strip aquifers")
+        x, y = np.broadcast_arrays(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+        shape = x.shape
+        x, y = np.array(x).ravel(), np.array(y).ravel()
+        xw, yw, Q, rw, xi = model.well_arrays()
+        n = xw.shape[0]
+        G_phi = np.empty((n + 1, x.shape[0]))
+        G_psi = np.empty((n + 1, x.shape[0]))
+        ref = kernels.omega_pairs(model.x, model.y, xw, yw, rw, xi).real/(2*np.pi)
+        for i in range(0, x.shape[0], block):
+            pairs = kernels.omega_pairs(x[i:i + block], y[i:i + block], xw, yw, rw, xi)/(2*np.pi)
+            G_phi[:n, i:i + block] = (pairs.real - ref).T
+            G_psi[:n, i:i + block] = pairs.imag.T
+        # baseflow (phi = -Qo_x*x, psi = -Qo_x*y):
+        G_phi[n] = model.x - x
+        G_psi[n] = -y
+        return cls(x, y, shape, G_phi, G_psi, model.wells.wellid.copy(), Q.copy(), model.Qo_x,
+                   model.k, model.H, model.phi_c)
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def _rates(self, Q, Qo_x):
+        # rates matrix (times x (wells + 1)) and whether a single vector of rates was given
+        Q = self.Q if Q is None else np.asarray(Q, dtype = float)
+        Qo_x = self.Qo_x if Qo_x is None else Qo_x
+        single = (Q.ndim == 1) and (np.ndim(Qo_x) == 0)
+        Q = np.atleast_2d(Q)
+        Qo_x = np.asarray(Qo_x, dtype = float).reshape(-1, 1)
+        Q, Qo_x = np.broadcast_arrays(Q, Qo_x)
+        rates = np.concatenate((Q, Qo_x[:, :1]), axis = 1)
+        return rates, single
+
+    def _shaped(self, values, single):
+        if single:
+            return values[0].reshape(self.shape)
+        return values.reshape((values.shape[0],) + self.shape)
+
+    def phi(self, Q = None, Qo_x = None):
+        """
+        Discharge potential at the points.
+
+        Parameters
+        ----------
+        Q: discharge rate of each well, array (wells) or time series (times x wells).
+           None: the rates of the model the matrices were built from.
+        Qo_x: baseflow, float or time series (times). None: the model baseflow.
+
+        Returns
+        -------
+        phi: numpy array with the shape of the points, or (times,) + shape for time series.
+
+        """
+        rates, single = self._rates(Q, Qo_x)
+        return self._shaped(self.phi_c + rates @ self.G_phi, single)
+
+    def head(self, Q = None, Qo_x = None):
+        """
+        Heads at the points (see phi).
+        """
+        return kernels.head_from_phi(self.phi(Q, Qo_x), self.k, self.H)
+
+    def psi(self, Q = None, Qo_x = None):
+        """
+        Stream function at the points (see phi).
+        """
+        rates, single = self._rates(Q, Qo_x)
+        return self._shaped(rates @ self.G_psi, single)
+
+    def save(self, path):
+        """
+        Saves the matrices to the directory path (created if needed): one .npy file per array
+        and the parameters in meta.json.
+        """
+        os.makedirs(path, exist_ok = True)
+        for name in ('x', 'y', 'G_phi', 'G_psi', 'wellid', 'Q'):
+            np.save(os.path.join(path, name + '.npy'), getattr(self, name))
+        meta = {'shape': list(self.shape), 'Qo_x': float(self.Qo_x), 'k': float(self.k),
+                'H': float(self.H), 'phi_c': float(self.phi_c)}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, path, mmap_mode = 'r'):
+        """
+        Loads matrices saved with save. With mmap_mode = 'r' (default) the arrays are read-only
+        memory maps, shared between the processes that load them. None: loads them in memory.
+        """
+        arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode = mmap_mode)
+                  for name in ('x', 'y', 'G_phi', 'G_psi', 'wellid', 'Q')}
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        return cls(**arrays, **meta)
+
+
+def read_wel_flows(path, Q, width):
+    """
+    Reads a pumping schedule in the format of the MODFLOW 6 well observations file
+    (wel_flows.csv, columns time, BASE_FLOW, PUMP_WEL) as rates for an influence matrix.
+
+    BASE_FLOW is the inflow through the boundary opposite to the river (positive), converted to
+    the baseflow per unit width Qo_x = -BASE_FLOW/width (towards the river). PUMP_WEL is the
+    total rate of the pumping wells (negative for extraction); it is split among the wells
+    proportionally to Q, with the AEM sign convention (positive for extraction).
+
+    Parameters
+    ----------
+    path: path of the csv file
+    Q: discharge rate of each well (e.g. InfluenceMatrix.Q), used as the share of PUMP_WEL.
+    width: length of the inflow boundary [L].
+
+    Returns
+    -------
+    time: numpy array (times)
+    Q: numpy array (times x wells) with the discharge rate of each well
+    Qo_x: numpy array (times) with the baseflow
+
+    """
+    flows = pd.read_csv(path)
+    flows.columns = [c.strip().upper() for c in flows.columns]
+    share = np.asarray(Q, dtype = float)/np.sum(Q)
+    Q = -flows['PUMP_WEL'].to_numpy()[:, np.newaxis]*share
+    Qo_x = -flows['BASE_FLOW'].to_numpy()/width
+    return flows['TIME'].to_numpy(), Q, Qo_x
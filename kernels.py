@@ -0,0 +1,549 @@
+# -*- coding: utf-8 -*-
+"""
+Calculation kernels of the AEM-RBF model.
+
+The kernels sum the contribution of all wells (and their images) at the points of
+interest. The model adds the reference potential phi0 and the baseflow.
+
+Two backends are available:
+
+    - numpy: reference implementation, vectorized with numpy broadcasting
+      (points x wells temporaries).
+    - numba: compiled loops over points and wells (no temporaries), parallel over the
+      points and releasing the GIL (module kernels_numba, imported only when requested).
+      Compiled functions are cached on disk (__pycache__), so new (worker) processes do
+      not compile them again.
+      Also provides a compiled particle tracker for solvers.river_length.time_travel.
+
+The scalar kernels (phi_point, psi_point, discharge_point, head_point) evaluate one point in
+plain python; the numba backend compiles them, so both share one definition of the formulas.
+
+Tolerance of the numba backend with respect to the numpy reference:
+    - phi, psi, omega and discharge: agree to floating point rounding (relative
+      difference < 1e-10).
+    - particle tracking: the stream function correction of each step is solved by Newton
+      iterations instead of scipy fsolve, both to xtol = 1e-4 [L]; travel times agree
+      with the reference loop within 0.1 % (relative).
+
+Tolerance of the other evaluations with respect to the numpy reference:
+    - far-field tree (farfield.WellTree, used by the model above Model.farfield_threshold
+      wells): phi and psi within Model.farfield_tol (absolute).
+    - reduced precision (omega_reduced, dtype = numpy.float32): 1e-6 of the total discharge
+      of the wells plus the float32 rounding of the value.
+
+test_kernels.py checks these bounds (the numba comparisons are skipped without numba):
+
+    python -m pytest test_kernels.py
+
+If numba is not installed, asking for the numba backend warns and returns the numpy backend.
+
+Well arrays (one entry per well): xw, yw (well coordinates), Q (discharge), rw (radius),
+xi (x-coordinate of the image well, the image is at y = yw; None: no images, for models without
+image river).
+"""
+import math
+import warnings
+import numpy as np
+
+
+class Backend:
+    """
+    Collection of calculation kernels used by the model.
+
+    Attributes
+    --------------------
+    name : backend name
+    phi(x, y, xw, yw, Q, rw, xi) : potential of the wells
+    psi(x, y, xw, yw, Q, rw, xi) : stream function of the wells
+    omega(x, y, xw, yw, Q, rw, xi) : complex potential of the wells
+    discharge(x, y, xw, yw, Q, rw, xi) : discharge vector and potential of the wells (Qx, Qy, phi)
+    track : particle tracker (or None if the backend has no compiled tracker)
+    """
+    def __init__(self, name, phi, psi, omega, discharge, track = None):
+        self.name = name
+        self.phi = phi
+        self.psi = psi
+        self.omega = omega
+        self.discharge = discharge
+        self.track = track
+
+    def __repr__(self):
+        return "Backend('{}')".format(self.name)
+
+
+'''
+numpy (reference) kernels
+'''
+
+def _points(x, y):
+    # Points of interest with a trailing axis for the wells
+    x = np.asarray(x, dtype = float)[..., np.newaxis]
+    y = np.asarray(y, dtype = float)[..., np.newaxis]
+    return x, y
+
+def phi_numpy(x, y, xw, yw, Q, rw, xi):
+    x, y = _points(x, y)
+    dx = x - xw
+    dy = y - yw
+    # Points within the well radius are shifted by rw (in x, otherwise in y):
+    near_x = np.abs(dx) <= rw
+    near_y = ~near_x & (np.abs(dy) <= rw)
+    dx = np.where(near_x, dx + rw, dx)
+    dy = np.where(near_y, dy + rw, dy)
+    if xi is None:
+        return np.sum((Q/(4*np.pi))*np.log(dx**2 + dy**2), axis = -1)
+    dxi = dx + (xw - xi) # distance to the image well
+    return np.sum((Q/(4*np.pi))*np.log((dx**2 + dy**2)/(dxi**2 + dy**2)), axis = -1)
+
+def psi_numpy(x, y, xw, yw, Q, rw, xi):
+    x, y = _points(x, y)
+    dx = x - xw
+    dy = y - yw
+    # At the well location the angle is taken from the well radius:
+    dx = np.where((dx == 0) & (dy == 0), -rw, dx)
+    if xi is None:
+        return np.sum((Q/(2*np.pi))*np.arctan2(dy, dx), axis = -1)
+    return np.sum((Q/(2*np.pi))*(np.arctan2(dy, dx) - np.arctan2(dy, x - xi)), axis = -1)
+
+_BLOCK = 1 << 13 # (point, well) pairs per block of omega_numpy
+
+def _pair_terms(x, y, xw, yw, rw, xi):
+    # real and imaginary parts of log(z - zw) - log(z - zi) for each well + image pair, in real
+    # arithmetic: the log of the ratio of the squared distances (with the near-well rw shifts of
+    # phi_numpy) and the angle between both directions, atan2(dy*(xw - xi), dx*(x - xi) + dy**2)
+    # (equal to the difference of the two arctan2 of psi_numpy, with the same branch cut).
+    # xi = None: log(z - zw) only.
+    x, y = _points(x, y)
+    dx = x - xw
+    dy = y - yw
+    # Points within the well radius are shifted by rw (in x, otherwise in y) for the potential:
+    near_x = np.abs(dx) <= rw
+    near_y = ~near_x & (np.abs(dy) <= rw)
+    dx_s = dx + rw*near_x
+    dy_s = dy + rw*near_y
+    dy2 = dy_s**2
+    # At the well location the angle is taken from the well radius:
+    dx_p = np.where((dx == 0) & (dy == 0), -rw, dx)
+    if xi is None:
+        return 0.5*np.log(dx_s**2 + dy2), np.arctan2(dy, dx_p)
+    s = xw - xi # well to image distance
+    re = 0.5*np.log((dx_s**2 + dy2)/((dx_s + s)**2 + dy2))
+    im = np.arctan2(dy*s, dx_p*(dx + s) + dy**2)
+    return re, im
+
+def omega_pairs(x, y, xw, yw, rw, xi):
+    """
+    Complex potential of each well + image pair for unit discharge, times 2 pi
+    (log(z - zw) - log(z - zi), with the near-well treatment of phi and psi; log(z - zw) if xi is None).
+    Evaluated in real arithmetic: one log and one arctan2 per pair.
+
+    Returns
+    -------
+    complex array with the broadcasted shape of x and y and a trailing axis for the wells.
+
+    """
+    re, im = _pair_terms(x, y, xw, yw, rw, xi)
+    omega = np.empty(re.shape, dtype = complex)
+    omega.real = re
+    omega.imag = im
+    return omega
+
+def omega_numpy(x, y, xw, yw, Q, rw, xi):
+    q = Q/(2*np.pi)
+    if (np.ndim(q) > 1) or (np.ndim(xi) > 1): # (ensembles: one pass with broadcasting)
+        re, im = _pair_terms(x, y, xw, yw, rw, xi)
+        omega = np.empty(re.shape[:-1], dtype = complex)
+        omega.real = np.sum(q*re, axis = -1)
+        omega.imag = np.sum(q*im, axis = -1)
+        return omega
+    # Blocks of points, so that the (points x wells) temporaries stay small (in cache):
+    x, y = np.broadcast_arrays(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+    shape = x.shape
+    x, y = x.ravel(), y.ravel()
+    omega = np.empty(x.shape, dtype = complex)
+    n = max(1, _BLOCK//max(1, np.shape(xw)[0]))
+    for i in range(0, x.shape[0], n):
+        re, im = _pair_terms(x[i:i + n], y[i:i + n], xw, yw, rw, xi)
+        omega.real[i:i + n] = re @ q
+        omega.imag[i:i + n] = im @ q
+    return omega.reshape(shape)
+
+def discharge_pairs(x, y, xw, yw, xi):
+    """
+    Discharge vector of each well + image pair for unit discharge.
+
+    Returns
+    -------
+    gx, gy: arrays with the broadcasted shape of x and y and a trailing axis for the wells.
+
+    """
+    x, y = _points(x, y)
+    dx = x - xw
+    dy = y - yw
+    r2 = dx**2 + dy**2
+    if xi is None:
+        return -(dx/r2)/(2*np.pi), -(dy/r2)/(2*np.pi)
+    dxi = x - xi
+    ri2 = dxi**2 + dy**2
+    return -(dx/r2 - dxi/ri2)/(2*np.pi), -(dy/r2 - dy/ri2)/(2*np.pi)
+
+def discharge_numpy(x, y, xw, yw, Q, rw, xi):
+    if xi is None:
+        gx, gy = discharge_pairs(x, y, xw, yw, None)
+        return np.sum(Q*gx, axis = -1), np.sum(Q*gy, axis = -1), phi_numpy(x, y, xw, yw, Q, rw, None)
+    x, y = _points(x, y)
+    dx = x - xw
+    dy = y - yw
+    dxi = x - xi
+    r2 = dx**2 + dy**2
+    ri2 = dxi**2 + dy**2
+    # Potential (same near-well rw shifts as phi):
+    near_x = np.abs(dx) <= rw
+    near_y = ~near_x & (np.abs(dy) <= rw)
+    shift_x = np.where(near_x, rw, 0)
+    shift_y = np.where(near_y, rw, 0)
+    phi = np.sum((Q/(4*np.pi))*np.log(((dx + shift_x)**2 + (dy + shift_y)**2)/
+                                      ((dxi + shift_x)**2 + (dy + shift_y)**2)), axis = -1)
+    # Discharge vector:
+    Qx = -np.sum((Q/(2*np.pi))*(dx/r2 - dxi/ri2), axis = -1)
+    Qy = -np.sum((Q/(2*np.pi))*(dy/r2 - dy/ri2), axis = -1)
+    return Qx, Qy, phi
+
+NUMPY = Backend('numpy', phi_numpy, psi_numpy, omega_numpy, discharge_numpy)
+
+
+'''
+scalar kernels: contribution of all wells at one point (images False: without the image wells),
+with the math module. Plain python for single points, where the numpy kernels cost more in
+overhead than in arithmetic (e.g. the tracking loop of solvers.river_length.time_travel, with
+the well columns as lists); kernels_numba compiles the same functions.
+'''
+
+def phi_point(x, y, xw, yw, Q, rw, xi, images):
+    phi = 0.0
+    for j in range(len(xw)):
+        dx = x - xw[j]
+        dy = y - yw[j]
+        # Points within the well radius are shifted by rw (in x, otherwise in y):
+        if abs(dx) <= rw[j]:
+            dx += rw[j]
+        elif abs(dy) <= rw[j]:
+            dy += rw[j]
+        if images:
+            dxi = dx + (xw[j] - xi[j])
+            phi += (Q[j]/(4*math.pi))*math.log((dx*dx + dy*dy)/(dxi*dxi + dy*dy))
+        else:
+            phi += (Q[j]/(4*math.pi))*math.log(dx*dx + dy*dy)
+    return phi
+
+def psi_point(x, y, xw, yw, Q, rw, xi, images):
+    psi = 0.0
+    for j in range(len(xw)):
+        dx = x - xw[j]
+        dy = y - yw[j]
+        if (dx == 0) and (dy == 0): # At the well location the angle is taken from the well radius
+            dx = -rw[j]
+        if images:
+            psi += (Q[j]/(2*math.pi))*(math.atan2(dy, dx) - math.atan2(dy, x - xi[j]))
+        else:
+            psi += (Q[j]/(2*math.pi))*math.atan2(dy, dx)
+    return psi
+
+def discharge_point(x, y, xw, yw, Q, xi, images):
+    Qx = 0.0
+    Qy = 0.0
+    for j in range(len(xw)):
+        dx = x - xw[j]
+        dy = y - yw[j]
+        r2 = dx*dx + dy*dy
+        if images:
+            dxi = x - xi[j]
+            ri2 = dxi*dxi + dy*dy
+            Qx -= (Q[j]/(2*math.pi))*(dx/r2 - dxi/ri2)
+            Qy -= (Q[j]/(2*math.pi))*(dy/r2 - dy/ri2)
+        else:
+            Qx -= (Q[j]/(2*math.pi))*(dx/r2)
+            Qy -= (Q[j]/(2*math.pi))*(dy/r2)
+    return Qx, Qy
+
+def head_point(phi, k, H):
+    # head from the potential (confined or unconfined conditions, as head_from_phi)
+    if phi >= 0.5*k*H**2:
+        return (phi + 0.5*k*H**2)/(k*H)
+    if phi >= 0:
+        return math.sqrt((2/k)*phi)
+    return math.nan
+
+
+def linesink_omega(x, y, z1, z2):
+    """
+    Complex potential of uniform line sinks from z1 to z2 (complex end points) with unit total
+    discharge (strength 1/length, positive for extraction, as the wells):
+
+        Omega = 1/(4 pi) [(Z + 1) log(Z + 1) - (Z - 1) log(Z - 1) - 2 + 2 log((z2 - z1)/2)]
+        Z = (2z - (z1 + z2))/(z2 - z1)
+
+    which tends to the potential of a well, log(z - zc)/(2 pi), far from the segment.
+
+    Returns
+    -------
+    complex array with the broadcasted shape of x and y and a trailing axis for the segments.
+
+    """
+    x, y = _points(x, y)
+    Z = (2*(x + 1j*y) - (z1 + z2))/(z2 - z1)
+    # (Z -+ 1) log(Z -+ 1) is 0 at the end points:
+    zp, zm = Z + 1, Z - 1
+    tp = np.where(zp == 0, 0, zp*np.log(np.where(zp == 0, 1, zp)))
+    tm = np.where(zm == 0, 0, zm*np.log(np.where(zm == 0, 1, zm)))
+    return (tp - tm - 2 + 2*np.log((z2 - z1)/2))/(4*np.pi)
+
+def linesink_discharge(x, y, z1, z2):
+    """
+    Discharge vector of uniform line sinks with unit total discharge (see linesink_omega),
+    Qx - iQy = -dOmega/dz.
+
+    Returns
+    -------
+    Qx, Qy: arrays with the broadcasted shape of x and y and a trailing axis for the segments.
+
+    """
+    x, y = _points(x, y)
+    Z = (2*(x + 1j*y) - (z1 + z2))/(z2 - z1)
+    # log of the ratio: branch cut on the segment only (log(Z + 1) - log(Z - 1) takes opposite
+    # branches on the extension of the segment when the imaginary part of Z is -0.0)
+    dOmega = np.log((Z + 1)/(Z - 1))/(2*np.pi*(z2 - z1))
+    return -dOmega.real, dOmega.imag
+
+
+def _log_cosh_cos(A, B):
+    # log(cosh(A) - cos(B)) without overflow for large A
+    A = np.abs(A)
+    e = np.exp(-A)
+    return A + np.log(0.5*(1 + e**2) - np.cos(B)*e)
+
+def gallery_omega(x, y, xw, yw, rw, xi, a):
+    """
+    Complex potential of infinite rows of wells (galleries) parallel to the y-axis, for unit
+    discharge of each well: wells at (xw, yw + n a) and images at (xi, yw + n a), n = ... -1, 0, 1 ...
+
+        Omega = 1/(2 pi) [log sinh(pi (z - zw)/a) - log sinh(pi (z - zi)/a)]
+
+    (the infinite sum of the well potentials, up to a constant). The potential is evaluated as
+    log(cosh(2 pi dx/a) - cos(2 pi dy/a)) and the stream function as the arctan of
+    tan(pi dy/a)/tanh(pi dx/a), without overflow far from the gallery, with the near-well
+    treatment of the well kernels (in the period of the points). xi = None: no images.
+
+    Returns
+    -------
+    complex array with the broadcasted shape of x and y and a trailing axis for the galleries.
+
+    """
+    x, y = _points(x, y)
+    w = 2*np.pi/a
+    dx = x - xw
+    dy = y - yw
+    dy_period = (dy + 0.5*a) % a - 0.5*a # distance to the closest well of the row
+    # Points within the well radius are shifted by rw (in x, otherwise in y) for the potential:
+    near_x = np.abs(dx) <= rw
+    near_y = ~near_x & (np.abs(dy_period) <= rw)
+    dx_s = np.where(near_x, dx + rw, dx)
+    dy_s = np.where(near_y, dy + rw, dy)
+    phi = _log_cosh_cos(w*dx_s, w*dy_s)
+    # At the well locations the angle is taken from the well radius:
+    dx_p = np.where((dx == 0) & (dy_period == 0), -rw, dx)
+    v = 0.5*w*dy
+    psi = np.arctan2(np.sin(v), np.cos(v)*np.tanh(0.5*w*dx_p))
+    if xi is not None:
+        dxi = x - xi
+        phi = phi - _log_cosh_cos(w*(dx_s + (xw - xi)), w*dy_s)
+        psi = psi - np.arctan2(np.sin(v), np.cos(v)*np.tanh(0.5*w*dxi))
+    return (0.5*phi + 1j*psi)/(2*np.pi)
+
+def gallery_discharge(x, y, xw, yw, xi, a):
+    """
+    Discharge vector of galleries with unit discharge of each well (see gallery_omega),
+    Qx - iQy = -dOmega/dz.
+
+    Returns
+    -------
+    Qx, Qy: arrays with the broadcasted shape of x and y and a trailing axis for the galleries.
+
+    """
+    x, y = _points(x, y)
+    z = x + 1j*y
+    dOmega = 1/np.tanh(np.pi*(z - (xw + 1j*yw))/a)
+    if xi is not None:
+        dOmega = dOmega - 1/np.tanh(np.pi*(z - (xi + 1j*yw))/a)
+    dOmega = dOmega/(2*a)
+    return -dOmega.real, dOmega.imag
+
+
+def strip_omega(x, y, xw, yw, rw, xi, width, wall = False):
+    """
+    Complex potential of each well + image pair for unit discharge in a strip aquifer, times 2 pi:
+    the river (x = (xw + xi)/2, i.e. x = -p) and a second boundary at x = width, a river
+    (head-specified, wall = False) or an impermeable wall (wall = True). The infinite series of
+    images of the well and its river image is summed in closed form (up to a constant):
+
+        river: log sin(pi (Z - a)/(2 W)) - log sin(pi (Z + conj(a))/(2 W))
+        wall:  log tan(pi (Z - a)/(4 W)) - log tan(pi (Z + conj(a))/(4 W))
+
+    with Z and a the point and well relative to the river, and W the strip width from the river.
+    The potential is evaluated as log(cosh - cos) and the stream function as arctan2 of
+    bounded terms, without overflow far from the wells, with the near-well treatment of the well
+    kernels. The branch cut of the stream function goes from the well to the river, as in omega_pairs.
+
+    Returns
+    -------
+    complex array with the broadcasted shape of x and y and a trailing axis for the wells.
+
+    """
+    x, y = _points(x, y)
+    x0 = 0.5*(xw + xi) # river line of each well (with the clogging factor)
+    a = xw - x0 # distance of the well to the river
+    n = 4 if wall else 2
+    w = np.pi/(n*(width - x0))
+    dx = x - xw
+    dy = y - yw
+    # Points within the well radius are shifted by rw (in x, otherwise in y) for the potential:
+    near_x = np.abs(dx) <= rw
+    near_y = ~near_x & (np.abs(dy) <= rw)
+    dx_s = np.where(near_x, dx + rw, dx)
+    dy_s = np.where(near_y, dy + rw, dy)
+    # log|sin(u + iv)|**2 = log(cosh(2v) - cos(2u)) - log(2), log|cos(u + iv)|**2 = log(cosh(2v) + cos(2u)) - log(2)
+    v2 = 2*w*dy_s
+    phi = _log_cosh_cos(v2, 2*w*dx_s) - _log_cosh_cos(v2, 2*w*(dx_s + 2*a))
+    if wall:
+        phi = phi - _log_cosh_cos(v2, 2*w*dx_s + np.pi) + _log_cosh_cos(v2, 2*w*(dx_s + 2*a) + np.pi)
+    # arg sin(u + iv) = arctan2(cos(u) tanh(v), sin(u)), at the well location from the well radius:
+    dx_p = np.where((dx == 0) & (dy == 0), -rw, dx)
+    t = np.tanh(w*dy)
+    u1, u2 = w*dx_p, w*(dx + 2*a)
+    psi = np.arctan2(np.cos(u1)*t, np.sin(u1)) - np.arctan2(np.cos(u2)*t, np.sin(u2))
+    if wall: # arg cos(u + iv) = arctan2(-sin(u) tanh(v), cos(u))
+        psi = psi - np.arctan2(-np.sin(u1)*t, np.cos(u1)) + np.arctan2(-np.sin(u2)*t, np.cos(u2))
+    return 0.5*phi + 1j*psi
+
+def strip_discharge(x, y, xw, yw, xi, width, wall = False):
+    """
+    Discharge vector of each well + image pair for unit discharge in a strip aquifer
+    (see strip_omega), Qx - iQy = -dOmega/dz.
+
+    Returns
+    -------
+    gx, gy: arrays with the broadcasted shape of x and y and a trailing axis for the wells.
+
+    """
+    x, y = _points(x, y)
+    x0 = 0.5*(xw + xi)
+    n = 4 if wall else 2
+    w = np.pi/(n*(width - x0))
+    z1 = w*((x - xw) + 1j*(y - yw))
+    z2 = w*((x + xw - 2*x0) + 1j*(y - yw))
+    if wall: # d/dz log tan = cot + tan
+        dOmega = 1/np.tan(z1) + np.tan(z1) - 1/np.tan(z2) - np.tan(z2)
+    else:
+        dOmega = 1/np.tan(z1) - 1/np.tan(z2)
+    dOmega = dOmega*w/(2*np.pi)
+    return -dOmega.real, dOmega.imag
+
+def strip_backend(width, wall = False):
+    """
+    Returns the numpy kernels of a strip aquifer between the river and a second river
+    (wall = False) or an impermeable wall (wall = True) at x = width (see strip_omega).
+    """
+    def omega(x, y, xw, yw, Q, rw, xi):
+        return np.sum((Q/(2*np.pi))*strip_omega(x, y, xw, yw, rw, xi, width, wall), axis = -1)
+
+    def phi(x, y, xw, yw, Q, rw, xi):
+        return omega(x, y, xw, yw, Q, rw, xi).real
+
+    def psi(x, y, xw, yw, Q, rw, xi):
+        return omega(x, y, xw, yw, Q, rw, xi).imag
+
+    def discharge(x, y, xw, yw, Q, rw, xi):
+        gx, gy = strip_discharge(x, y, xw, yw, xi, width, wall)
+        return np.sum(Q*gx, axis = -1), np.sum(Q*gy, axis = -1), phi(x, y, xw, yw, Q, rw, xi)
+
+    return Backend('strip', phi, psi, omega, discharge)
+
+def omega_reduced(x, y, xw, yw, Q, rw, xi, dtype = np.float32):
+    """
+    Potential and stream function of the wells in reduced precision (e.g. float32), with half
+    the memory and bandwidth of the reference kernels.
+    
+    Coordinates should be given relative to a local origin (close to the wells) so that the
+    distances to the wells are not lost in rounding. The potential uses the log of the ratio of
+    the squared distances to the well and to the image; the stream function uses the angle between
+    both directions, atan2(dy*(xw - xi), dx*(x - xi) + dy**2), instead of the difference of two
+    arctan2 terms (equal to it, without the cancellation of close angles far from the wells).
+    xi = None: no images.
+
+    Returns
+    -------
+    phi, psi: arrays (dtype) with the broadcasted shape of x and y.
+
+    """
+    x = np.asarray(x).astype(dtype, copy = False)[..., np.newaxis]
+    y = np.asarray(y).astype(dtype, copy = False)[..., np.newaxis]
+    xw, yw, rw = (np.asarray(v, dtype = dtype) for v in (xw, yw, rw))
+    q = np.asarray(np.divide(Q, 4*np.pi, dtype = float), dtype = dtype)
+    dx = x - xw
+    dy = y - yw
+    # Points within the well radius are shifted by rw (in x, otherwise in y) for the potential:
+    near_x = np.abs(dx) <= rw
+    near_y = ~near_x & (np.abs(dy) <= rw)
+    dx_s = np.where(near_x, dx + rw, dx)
+    dy_s = np.where(near_y, dy + rw, dy)
+    # At the well location the angle is taken from the well radius:
+    dx_p = np.where((dx == 0) & (dy == 0), -rw, dx)
+    if xi is None:
+        phi = np.sum(q*np.log(dx_s**2 + dy_s**2), axis = -1)
+        psi = np.sum((2*q)*np.arctan2(dy, dx_p), axis = -1)
+        return phi, psi
+    s = np.asarray(np.subtract(xw, xi, dtype = float), dtype = dtype) # well to image distance
+    phi = np.sum(q*np.log((dx_s**2 + dy_s**2)/((dx_s + s)**2 + dy_s**2)), axis = -1)
+    psi = np.sum((2*q)*np.arctan2(dy*s, dx_p*(dx + s) + dy**2), axis = -1)
+    return phi, psi
+
+
+def head_from_phi(phi, k, H):
+    """
+    Converts discharge potential to head (confined or unconfined conditions, Haitjema 1995).
+    phi, k, H: floats or broadcastable numpy arrays.
+    """
+    phicrit = 0.5 * k * H **2
+    confined = phi >= phicrit
+    h = np.where(confined,
+                 (phi + 0.5*k*H**2)/(k*H), # Confined conditions
+                 np.sqrt((2 / k) * np.where(confined, phicrit, phi))) # Unconfined conditions
+    return h[()]
+
+
+def get_backend(backend = 'numpy'):
+    """
+    Returns the calculation backend.
+
+    Parameters
+    ----------
+    backend: 'numpy', 'numba', 'auto' (numba if installed, else numpy) or a Backend object.
+
+    Returns
+    -------
+    Backend object.
+
+    """
+    if isinstance(backend, Backend):
+        return backend
+    if backend == 'numpy':
+        return NUMPY
+    if backend in ('numba', 'auto'):
+        try:
+            from kernels_numba import NUMBA
+            return NUMBA
+        except ImportError:
+            if backend == 'numba':
+                warnings.warn("numba is not installed, using the numpy backend")
+            return NUMPY
+    raise ValueError("Unknown backend: {}".format(backend))
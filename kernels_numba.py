@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+numba backend of the AEM-RBF model kernels (see kernels.py).
+
+Loops over points (in parallel) and wells, without temporary arrays, releasing the GIL.
+Functions are compiled on first use and cached on disk (cache = True).
+Requires numba; importing this module raises ImportError if it is not installed.
+"""
+import math
+import numba
+import numpy as np
+
+import kernels
+from kernels import Backend
+
+jit = numba.njit(cache = True, nogil = True, error_model = 'numpy')
+pjit = numba.njit(cache = True, nogil = True, parallel = True, error_model = 'numpy')
+
+
+'''
+scalar kernels (kernels.py), compiled
+'''
+
+phi_point = jit(kernels.phi_point)
+psi_point = jit(kernels.psi_point)
+discharge_point = jit(kernels.discharge_point)
+head_point = jit(kernels.head_point)
+
+
+'''
+loops over the points
+'''
+
+@pjit
+def phi_loop(x, y, xw, yw, Q, rw, xi, images, out):
+    for i in numba.prange(x.shape[0]):
+        out[i] = phi_point(x[i], y[i], xw, yw, Q, rw, xi, images)
+
+@pjit
+def psi_loop(x, y, xw, yw, Q, rw, xi, images, out):
+    for i in numba.prange(x.shape[0]):
+        out[i] = psi_point(x[i], y[i], xw, yw, Q, rw, xi, images)
+
+@pjit
+def discharge_loop(x, y, xw, yw, Q, rw, xi, images, Qx, Qy, phi):
+    for i in numba.prange(x.shape[0]):
+        Qx[i], Qy[i] = discharge_point(x[i], y[i], xw, yw, Q, xi, images)
+        phi[i] = phi_point(x[i], y[i], xw, yw, Q, rw, xi, images)
+
+@jit
+def specific_discharge_point(x, y, ne, xw, yw, Q, rw, xi, images, phi0, Qo_x, k, H):
+    # velocity (specific discharge / porosity) at one point
+    Qx, Qy = discharge_point(x, y, xw, yw, Q, xi, images)
+    b = min(head_point(phi0 + phi_point(x, y, xw, yw, Q, rw, xi, images) - Qo_x*x, k, H), H)
+    return (Qx + Qo_x)/b/ne, Qy/b/ne
+
+@pjit
+def track_loop(xs, ys, ne, delta_s, x_stop, y_stop, r_stop, r_break, xw, yw, Q, rw, xi, images,
+               phi0, Qo_x, k, H, xtol, max_steps, tt, traj_x, traj_y, n_steps):
+    '''
+    Particle tracking with the algorithm of solvers.river_length.time_travel.
+    The stream function correction is solved with Newton iterations (dpsi/dx = Qy, dpsi/dy = -Qx).
+    traj_x, traj_y: arrays (particles x max_steps+1) to store the trajectories (width 0: not stored)
+    '''
+    store = traj_x.shape[1] > 0
+    for i in numba.prange(xs.shape[0]):
+        x1 = xs[i]
+        y1 = ys[i]
+        psi = psi_point(x1, y1, xw, yw, Q, rw, xi, images) - Qo_x*y1
+        t = 0.0
+        step = 0
+        if store:
+            traj_x[i, 0] = x1
+            traj_y[i, 0] = y1
+        while (math.hypot(x1 - x_stop, y1 - y_stop) > r_stop) and (step < max_steps):
+            vx, vy = specific_discharge_point(x1, y1, ne, xw, yw, Q, rw, xi, images, phi0, Qo_x, k, H)
+            v_i = math.hypot(vx, vy)
+            x2 = x1 + delta_s*vx/v_i
+            y2 = y1 + delta_s*vy/v_i
+            if math.hypot(x2 - x_stop, y2 - y_stop) < r_break:
+                break
+            # correcting the point location based on the psi value:
+            for it in range(50):
+                res = psi_point(x2, y2, xw, yw, Q, rw, xi, images) - Qo_x*y2 - psi
+                Qx2, Qy2 = discharge_point(x2, y2, xw, yw, Q, xi, images)
+                if abs(vx) > abs(vy):
+                    dstep = -res/(Qx2 + Qo_x)
+                    y2 -= dstep
+                else:
+                    dstep = res/Qy2
+                    x2 -= dstep
+                if abs(dstep) < xtol:
+                    break
+            dist = math.hypot(x2 - x1, y2 - y1)
+            vx2, vy2 = specific_discharge_point(x2, y2, ne, xw, yw, Q, rw, xi, images, phi0, Qo_x, k, H)
+            t += dist/math.hypot(0.5*(vx + vx2), 0.5*(vy + vy2))
+            x1 = x2
+            y1 = y2
+            step += 1
+            if store and (step < traj_x.shape[1]):
+                traj_x[i, step] = x1
+                traj_y[i, step] = y1
+        tt[i] = t
+        n_steps[i] = step
+
+
+'''
+backend functions (same signatures as the numpy kernels)
+'''
+
+def _flat_points(x, y):
+    # Broadcasted points as contiguous 1d arrays
+    x, y = np.broadcast_arrays(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+    return np.ascontiguousarray(x).ravel(), np.ascontiguousarray(y).ravel(), x.shape
+
+def _columns(*columns):
+    return tuple(np.ascontiguousarray(c, dtype = float) for c in columns)
+
+def _wells(xw, yw, Q, rw, xi):
+    # Well columns and the images flag (xi = None: no images, xi is not used)
+    return _columns(xw, yw, Q, rw, xw if xi is None else xi) + (xi is not None,)
+
+def phi(x, y, xw, yw, Q, rw, xi):
+    xf, yf, shape = _flat_points(x, y)
+    out = np.empty(xf.shape[0])
+    phi_loop(xf, yf, *_wells(xw, yw, Q, rw, xi), out)
+    return out.reshape(shape)[()]
+
+def psi(x, y, xw, yw, Q, rw, xi):
+    xf, yf, shape = _flat_points(x, y)
+    out = np.empty(xf.shape[0])
+    psi_loop(xf, yf, *_wells(xw, yw, Q, rw, xi), out)
+    return out.reshape(shape)[()]
+
+def omega(x, y, xw, yw, Q, rw, xi):
+    return phi(x, y, xw, yw, Q, rw, xi) + 1j*psi(x, y, xw, yw, Q, rw, xi)
+
+def discharge(x, y, xw, yw, Q, rw, xi):
+    xf, yf, shape = _flat_points(x, y)
+    Qx, Qy, ph = np.empty(xf.shape[0]), np.empty(xf.shape[0]), np.empty(xf.shape[0])
+    discharge_loop(xf, yf, *_wells(xw, yw, Q, rw, xi), Qx, Qy, ph)
+    return Qx.reshape(shape)[()], Qy.reshape(shape)[()], ph.reshape(shape)[()]
+
+def track(xs, ys, ne, delta_s, x_stop, y_stop, r_stop, r_break, xw, yw, Q, rw, xi,
+          phi0, Qo_x, k, H, xtol = 1e-4, max_steps = 100000, trajectory = False):
+    """
+    Compiled particle tracking (algorithm of solvers.river_length.time_travel).
+    Particles start at (xs, ys) and stop within r_stop of (x_stop, y_stop), or if the next step
+    falls within r_break of it.
+
+    Returns
+    -------
+    tt: travel time of each particle
+    trajectories: list of [2 x n] arrays (x, y positions) for each particle (None if trajectory is False)
+
+    """
+    xs, ys = _columns(xs, ys)
+    n = xs.shape[0]
+    width = max_steps + 1 if trajectory else 0
+    traj_x, traj_y = np.empty((n, width)), np.empty((n, width))
+    tt, n_steps = np.empty(n), np.empty(n, dtype = np.int64)
+    track_loop(xs, ys, float(ne), float(delta_s), float(x_stop), float(y_stop), float(r_stop), float(r_break),
+               *_wells(xw, yw, Q, rw, xi), float(phi0), float(Qo_x), float(k), float(H),
+               float(xtol), int(max_steps), tt, traj_x, traj_y, n_steps)
+    if not trajectory:
+        return tt, None
+    return tt, [np.vstack((traj_x[i, :n_steps[i]+1], traj_y[i, :n_steps[i]+1])) for i in range(n)]
+
+NUMBA = Backend('numba', phi, psi, omega, discharge, track)
@@ -5,35 +5,277 @@ Created on Fri Nov 12 10:18:14 2021
 @authors: vcantarella, marigomez, alevilla
 """
 
+import contextlib
 import numpy as np
 import pandas as pd
+from scipy.linalg import lu_factor, lu_solve
+
+import farfield
+import influence
+import kernels
+import plans
+import transient
 
 class River:
     """
     Optional class to input the river coordinates.
-    If given, will output the rotation matrix for the coordinates with the rot_matrix method
+    The river is the line through the nodes (x1,y1) and (x2,y2) (real-world coordinates). The model
+    works in the river frame: the river is the y-axis, the y-axis points from (x1,y1) to (x2,y2) and
+    the aquifer (positive x) is on the right-hand side of that direction (swap the nodes for the
+    other side). (x1,y1) is the origin of the river frame.
+    
+    The transform is affine (rotation + translation) and vectorized: transform point clouds, grids
+    or trajectories once, at the input and output of the model, with to_local and to_global:
+    
+        model = Model(k, H, h0, river = river)
+        model.add_wells(*river.to_local(x_wells, y_wells), Q = Q, rw = 0.2)
+        h = model.calc_head(*river.to_local(x_obs, y_obs))
+    
     Inputs: x,y coordinates for two river nodes (x1,y1) and (x2,y2)
     """
     def __init__(self,x1,y1,x2,y2):
-        self.m = (y2-y1)/(x2-x1)
-        self.theta = np.where(np.arctan(self.m)> 0, np.pi - np.arctan(self.m),
-                              -np.pi - np.arctan(self.m))
+        length = np.hypot(x2 - x1, y2 - y1)
+        if length == 0:
+            raise ValueError("The river nodes must be different points")
+        self.x1 = x1
+        self.y1 = y1
+        # angle of the rotation from real-world coordinates to the river frame:
+        self.theta = np.arctan2((x2 - x1)/length, (y2 - y1)/length)
+        # river line in the river frame (river_a*x + river_b*y + river_c = 0), used by the model:
+        self.river_a = 1
+        self.river_b = 0
+        self.river_c = 0
+    
     def rot_matrix(self):
         """
         returns the rotation matrix (2d numpy array) that guarantee the river is parallel to y axis
         
         """
         t = self.theta
-        return(np.array([np.cos(t), -np.sin(t)],
-                        [np.sin(t), np.cos(t)]))
+        return(np.array([[np.cos(t), -np.sin(t)],
+                         [np.sin(t), np.cos(t)]]))
     
-    def operator(self,x,y):
+    def to_local(self, x, y):
         """
         returns the rotated and translated coordinates for the river system:
-        input (x, y)
-        outputs: translated (x', y')
+        input (x, y): real-world coordinates, floats or numpy arrays of any (broadcastable) shape
+        outputs: (x', y') in the river frame, with the broadcasted shape of x and y
+        """
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        dx = np.asarray(x, dtype = float) - self.x1
+        dy = np.asarray(y, dtype = float) - self.y1
+        return c*dx - s*dy, s*dx + c*dy
+    
+    operator = to_local
+    
+    def to_global(self, x, y):
+        """
+        inverse of to_local:
+        input (x', y'): coordinates in the river frame (floats or arrays)
+        outputs: real-world (x, y)
+        """
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        x = np.asarray(x, dtype = float)
+        y = np.asarray(y, dtype = float)
+        return self.x1 + c*x + s*y, self.y1 - s*x + c*y
+    
+    def vector_to_global(self, vx, vy):
         """
-        return None
+        rotates vectors (e.g. the discharge vector of Model.calc_discharge) from the river frame
+        to real-world components
+        """
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        vx = np.asarray(vx, dtype = float)
+        vy = np.asarray(vy, dtype = float)
+        return c*vx + s*vy, -s*vx + c*vy
+    
+    def vector_to_local(self, vx, vy):
+        """
+        rotates vectors from real-world components to the river frame
+        """
+        c, s = np.cos(self.theta), np.sin(self.theta)
+        vx = np.asarray(vx, dtype = float)
+        vy = np.asarray(vy, dtype = float)
+        return c*vx - s*vy, s*vx + c*vy
+
+
+def reference_potential(k, H, h0):
+    """
+    Discharge potential for the head h0 (confined or unconfined conditions).
+    k, H, h0: floats or broadcastable arrays.
+    """
+    h0 = np.asarray(h0)
+    return np.where(h0 < H, 0.5 * k * h0 **2, k * H * h0 - 0.5 * k * H **2)[()]
+
+
+class WellTable:
+    """
+    Struct-of-arrays table with the wells of an AEM-RBF model.
+    Every column is stored as a contiguous float64 numpy array, so the calculation
+    methods of the model work on arrays instead of looping over Well objects.
+    The Well objects are handles to a row of this table.
+    
+    Columns
+    --------------------
+    x, y : well coordinates
+    Q : well discharge rate
+    rw : well radius
+    d : distance from the well to the river line
+    xi, yi : coordinates of the image well
+    wellid : integer identifier of the well (int64 array)
+    
+    The derived columns (d, xi, yi) are cached: they are only recalculated when the river line
+    or the clogging factor change, or when a well is added or moved through its Well handle.
+    The columns are read-only views: changes go through the table methods (set_column) or the
+    Well handles, which increment the version counter (used to invalidate data derived from the
+    wells, e.g. the far-field tree); geometry_version only when wells are added, moved or
+    resized (rw), or the image geometry changes.
+    """
+    columns = ('x', 'y', 'Q', 'rw', 'd', 'xi', 'yi')
+    _rows = {name: row for row, name in enumerate(columns)}
+    
+    def __init__(self, capacity = 16):
+        self._data = np.zeros((len(self.columns), capacity)) # each row is a contiguous column
+        self._wellid = np.zeros(capacity, dtype = np.int64)
+        self.n = 0
+        self._next_id = 0
+        self._image_key = None # (river_a, river_b, river_c, p) of the cached image geometry
+        self.version = 0
+        self.geometry_version = 0
+    
+    def __len__(self):
+        return self.n
+    
+    def _reserve(self, n):
+        """
+        Grows the table storage (doubling the capacity) to hold at least n wells.
+        """
+        capacity = self._data.shape[1]
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        data = np.zeros((len(self.columns), capacity))
+        data[:, :self.n] = self._data[:, :self.n]
+        wellid = np.zeros(capacity, dtype = np.int64)
+        wellid[:self.n] = self._wellid[:self.n]
+        self._data = data
+        self._wellid = wellid
+    
+    def append(self, x, y, Q, rw):
+        """
+        Adds wells to the table. Inputs are floats or 1d arrays of equal length.
+
+        Returns
+        -------
+        index of the first added row in the table.
+
+        """
+        x, y, Q, rw = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype = float)) for v in (x, y, Q, rw)))
+        start = self.n
+        stop = start + x.shape[0]
+        self._reserve(stop)
+        for name, values in zip(('x', 'y', 'Q', 'rw'), (x, y, Q, rw)):
+            self._data[self._rows[name], start:stop] = values
+        self.invalidate()
+        self._wellid[start:stop] = np.arange(self._next_id, self._next_id + stop - start)
+        self._next_id += stop - start
+        self.n = stop
+        return start
+    
+    def remove(self, indices):
+        """
+        Removes the wells at the given row indices (int or array). The rows after them move up,
+        keeping their order (the index of the Well handles must be updated, see Model.remove_wells).
+        """
+        keep = np.ones(self.n, dtype = bool)
+        keep[indices] = False
+        n = int(keep.sum())
+        self._data[:, :n] = self._data[:, :self.n][:, keep]
+        self._wellid[:n] = self._wellid[:self.n][keep]
+        self.n = n
+        self.invalidate()
+    
+    def _column(self, name):
+        # writable view of the column name with the active wells
+        if name == 'wellid':
+            return self._wellid[:self.n]
+        return self._data[self._rows[name], :self.n]
+    
+    def column(self, name):
+        """
+        Returns a read-only view (no copy) of the column name with the active wells.
+        Changes go through set_column or the Well handles, which update the version counters.
+        """
+        view = self._column(name)
+        view.flags.writeable = False
+        return view
+    
+    def set_column(self, name, values, indices = slice(None)):
+        """
+        Sets the values of the column name ('x', 'y', 'Q' or 'rw') for the wells at the row
+        indices (all the wells by default), e.g. wells.set_column('Q', rates).
+        """
+        if name not in ('x', 'y', 'Q', 'rw'):
+            raise ValueError("Only the x, y, Q and rw columns can be set")
+        self._column(name)[indices] = values
+        if name in ('x', 'y'): # moving wells changes the image geometry
+            self.invalidate()
+        elif name == 'rw': # the radius shifts the points near the wells (see kernels.omega_pairs)
+            self.version += 1
+            self.geometry_version += 1
+        else:
+            self.version += 1
+    
+    x = property(lambda self: self.column('x'))
+    y = property(lambda self: self.column('y'))
+    Q = property(lambda self: self.column('Q'))
+    rw = property(lambda self: self.column('rw'))
+    d = property(lambda self: self.column('d'))
+    xi = property(lambda self: self.column('xi'))
+    yi = property(lambda self: self.column('yi'))
+    wellid = property(lambda self: self.column('wellid'))
+    
+    def invalidate(self):
+        """
+        Marks the cached image geometry as outdated (e.g. after moving wells).
+        """
+        self._image_key = None
+        self.version += 1
+        self.geometry_version += 1
+    
+    def image_geometry(self, river_a, river_b, river_c, p, images = True):
+        """
+        Returns the distance to the river and the image well coordinates for the river line
+        (river_a*x + river_b*y + river_c = 0) and clogging factor p. images is part of the cache
+        key only (the versions change when the image river is switched on or off).
+        The values are recalculated only if the river line, p or the wells changed since the last call.
+
+        Returns
+        -------
+        d, xi, yi: views of the cached columns.
+
+        """
+        key = (river_a, river_b, river_c, p, images)
+        if self._image_key != key:
+            d, xi, yi = self._column('d'), self._column('xi'), self._column('yi')
+            np.divide(np.abs(river_a *self.x + river_b*self.y + river_c), np.sqrt(river_a**2+ river_b**2), out = d)
+            np.subtract(self.x, 2*d + 2*p, out = xi)
+            yi[:] = self.y
+            self._image_key = key
+            self.version += 1
+            self.geometry_version += 1
+        return self.d, self.xi, self.yi
+    
+    def to_frame(self):
+        """
+        Returns a pandas DataFrame with the wells, backed by the table columns (no copies).
+        """
+        return pd.DataFrame({'wellid' : self.wellid,
+                             'Discharge': self.Q,
+                             'X': self.x,
+                             'Y': self.y,
+                             'rw': self.rw}, copy = False)
 
 
 class Model:
@@ -42,31 +284,68 @@ class Model:
     This object contains the methods to calculate discharge potential, heads and 
     stream function from the aem objects.
     
-    Currently only supports models with default river location (y-axis)
+    The model works in the river frame: the river is the y-axis and the aquifer is x > 0.
+    For real-world river orientations give a River object and transform the coordinates at the
+    input and output of the model (to_local, to_global).
     
     Parameters
     --------------------
     k : hydraulic conductivity
     H : aquifer Height
     h0 : aquifer head at the reference location (measured from the base of the aquifer)
-    river: river object (not implemented yet)
-    x_ref : x-coordinate of the reference location
-    y_ref : y-coordinate of the reference location
+    river: River object (real-world river location), None: the river is the y-axis
+    x_ref : x-coordinate of the reference location (river frame)
+    y_ref : y-coordinate of the reference location (river frame). With a LineSinkRiver the
+            reference location must be off the river (the default x_ref = y_ref = 0 is on the
+            river when the LineSinkRiver follows the y-axis): farther from each segment than a
+            tenth of its length, otherwise update_phi0 raises ValueError.
+    backend : calculation kernels, 'numpy' (reference), 'numba' (compiled, optional dependency)
+              or 'auto' (numba if installed). See kernels.py.
+    
+    images : if True (default) the river is the y-axis, with image wells (and image line sinks).
+             False: no image river, e.g. for models with a LineSinkRiver (the kernels skip
+             the image wells: xi = None in well_arrays).
+    elements : analytic elements other than wells (e.g. LineSinkRiver), added to the potential,
+               stream function and discharge of the wells. Head-specified elements are solved,
+               together with phi0, in update_phi0.
+    strip : None (default, semi-infinite aquifer) or the x-coordinate of a second boundary
+            parallel to the river (river frame), for strip aquifers between the river and a canal
+            (strip_boundary = 'river', head-specified) or an impermeable valley wall
+            (strip_boundary = 'wall', only without baseflow, Qo_x = 0: a uniform baseflow would
+            cross the wall). The image series of the wells is summed in closed form
+            (see kernels.strip_omega): the cost is close to the single-river case. Elements
+            other than wells keep the single river image; the second boundary has no clogging.
+    S : storage coefficient (specific yield for unconfined aquifers), None by default. Needed for
+        transient (Theis) evaluations of the wells (Model.transient, see transient.py).
+    
+    Attributes for models with many wells (see farfield.py):
+    farfield_threshold : number of wells above which the far-field (multipole) approximation is
+                         used by the calculation methods (500 by default, None: always direct
+                         summation). Above it the tree is faster for grids in any layout (3 to 4
+                         times in compact well fields, 20 times for 3000 wells along 20 km); its
+                         build costs about 10 ms (see farfield.py).
+    farfield_tol : maximum error of the far-field approximation of the potential [L3/T]
+    
+    Ensembles: k, H, h0 (given to the constructor), Qo_x and p (set as attributes or with
+    calc_clogging) can be numpy arrays, broadcastable against each other, along ensemble axes
+    (e.g. k = np.array([5, 10, 20]) for three conductivities, or shapes (3, 1) and (1, 4) for all
+    combinations of two parameters). The calculation methods then return arrays with the ensemble
+    axes first, followed by the axes of the points: shape ensemble_shape + np.broadcast(x, y).shape.
+    Ensemble models always use the numpy kernels (no far-field approximation) and do not
+    support evaluation plans. Call update_phi0 after changing Qo_x.
     
     """
-    def __init__(self, k, H, h0, river = None, x_ref = 0, y_ref = 0):
+    def __init__(self, k, H, h0, river = None, x_ref = 0, y_ref = 0, backend = 'numpy'):
         self.k = k
         self.H = H
         self.h0 = h0
         self.aem_elements = []
-        self.well_df = pd.DataFrame({'wellid' : [],
-                                     'Discharge': [],
-                                     'X': [],
-                                     'Y': []})
+        self.wells = WellTable() # Well parameters, the Well objects are handles to this table
         self.Qo_x = -1  #Baseflow in the x direction
         self.p = 0 #River clogging factor
         self.x = x_ref
         self.y = y_ref
+        self.river = river
         if river is None:
             # If undeclared river line equation will be assumed to be located at the y-axis
             self.river_a = 1
@@ -76,96 +355,404 @@ class Model:
             self.river_a = river.river_a
             self.river_b = river.river_b
             self.river_c = river.river_c
-        if self.h0 < self.H:
-            self.phi_c = 0.5 * self.k * self.h0 **2
-        else:
-            self.phi_c = self.k * self.H * self.h0 - 0.5 * self.k * self.H **2
+        self.phi_c = reference_potential(self.k, self.H, self.h0)
         self.phi0 = self.phi_c
+        self._defer_phi0 = 0 # nesting level of defer_phi0 blocks
+        self._phi0_pending = False
+        self.backend = backend
+        self.farfield_threshold = 500
+        self.farfield_tol = 1e-6
+        self._tree = None
+        self._tree_key = None
+        self.images = True
+        self.elements = []
+        self._lu = None # cached factorization of the head-specified elements system
+        self._lu_key = None
+        self.S = None # storage coefficient, for transient evaluations
+        self.strip = None # second boundary of strip aquifers (x-coordinate)
+        self.strip_boundary = 'river' # 'river' or 'wall'
+    
+    @property
+    def backend(self):
+        """
+        Calculation kernels used by the model (kernels.Backend). Can be set with the backend name.
+        """
+        return self._backend
+    
+    @backend.setter
+    def backend(self, backend):
+        self._backend = kernels.get_backend(backend)
+    
+    def to_local(self, x, y):
+        """
+        Transforms real-world coordinates (floats or arrays: point clouds, grids, trajectories)
+        to the river frame of the model (see River.to_local). Without river, returns x, y.
+        """
+        if self.river is None:
+            return x, y
+        return self.river.to_local(x, y)
+    
+    def to_global(self, x, y):
+        """
+        Transforms coordinates of the river frame of the model to real-world coordinates
+        (see River.to_global). Without river, returns x, y.
+        """
+        if self.river is None:
+            return x, y
+        return self.river.to_global(x, y)
+    
+    @property
+    def ensemble_shape(self):
+        """
+        Shape of the ensemble axes of the model parameters (() for a single model).
+        """
+        values = (self.k, self.H, self.h0, self.Qo_x, self.p, self.x, self.y)
+        if not any(isinstance(v, np.ndarray) and v.ndim for v in values): # (fast path, called often)
+            return ()
+        return np.broadcast_shapes(*(np.shape(v) for v in values))
+    
+    def _expand(self, value, ndim):
+        # Ensemble parameter with ndim trailing axes for the points (scalars unchanged)
+        if not (isinstance(value, np.ndarray) and value.ndim):
+            return value
+        return value.reshape(value.shape + (1,)*ndim)
+    
+    def _ensemble_wells(self, ndim):
+        # well arrays with the ensemble image wells (xi: ensemble axes + ndim point axes + wells)
+        xw, yw, Q, rw, xi = self.well_arrays()
+        if (xi is not None) and (xi.ndim > 1):
+            xi = xi.reshape(xi.shape[:-1] + (1,)*ndim + xi.shape[-1:])
+        return xw, yw, Q, rw, xi
+    
+    def kernel(self):
+        """
+        Returns the kernels used for the current wells: the model backend, or the far-field
+        approximation (farfield.WellTree, rebuilt when the wells change) if the model has more
+        than farfield_threshold wells (the tree expands well + image pairs: not used without
+        image river). Ensemble models use the numpy kernels, strip aquifers the strip kernels
+        (kernels.strip_backend).
+        """
+        if self.strip is not None:
+            if self.strip_boundary not in ('river', 'wall'):
+                raise ValueError("strip_boundary must be 'river' or 'wall'")
+            if not self.images:
+                raise ValueError("Strip aquifers need the river images (images = True)")
+            if (self.strip_boundary == 'wall') and np.any(np.asarray(self.Qo_x) != 0):
+                raise ValueError("The valley wall is impermeable: strip aquifers with strip_boundary = 'wall' need Qo_x = 0")
+            return kernels.strip_backend(self.strip, self.strip_boundary == 'wall')
+        if self.ensemble_shape != ():
+            return kernels.NUMPY
+        if ((self.farfield_threshold is None) or (len(self.wells) <= self.farfield_threshold) or
+                not self.images):
+            return self.backend
+        wells = self.well_arrays()
+        key = (self.wells.version, self.farfield_tol)
+        if self._tree_key != key:
+            self._tree = farfield.WellTree(*wells, tol = self.farfield_tol).backend()
+            self._tree_key = key
+        return self._tree
+    
+    @property
+    def well_df(self):
+        """
+        pandas DataFrame with the model wells (wellid, Discharge, X, Y, rw) backed by the well table.
+        """
+        return self.wells.to_frame()
+    
+    def well_arrays(self):
+        """
+        Returns the well table columns, with one entry per well, ready to be
+        broadcasted against the points of interest.
+
+        Returns
+        -------
+        xw, yw, Q, rw, xi: numpy arrays with the well coordinates, discharge, radius and
+        the x-coordinate of the image wells (ensemble axes + wells if p is an array; None
+        without image river, see kernels.py).
+
+        """
+        wells = self.wells
+        d, xi, yi = self.image_geometry()
+        return wells.x, wells.y, wells.Q, wells.rw, xi if self.images else None
+    
+    def image_geometry(self):
+        """
+        Returns the cached image well geometry of the model wells (see WellTable.image_geometry).
+
+        Returns
+        -------
+        d, xi, yi: numpy arrays with the distance of each well to the river and the image well coordinates.
+        For ensembles of p, xi has the ensemble axes first (not cached). Without image river
+        (images False) xi, yi are the mirror locations for p = 0, not used by the kernels.
+
+        """
+        if (np.ndim(self.p) > 0) and self.images:
+            d, xi, yi = self.wells.image_geometry(self.river_a, self.river_b, self.river_c, 0)
+            return d, xi - 2*np.asarray(self.p)[..., np.newaxis], yi
+        return self.wells.image_geometry(self.river_a, self.river_b, self.river_c,
+                                         self.p if self.images else 0, self.images)
     
     def calc_phi(self, x, y):
         """
         Method to calculate the discharge potential at given location:
         
-        Currently only supports models with default river location (y-axis)
+        Coordinates in the river frame (see to_local)
 
         Parameters
         ----------
-        x,y location of interest.
+        x,y location of interest. Floats or numpy arrays of any (broadcastable) shape.
 
         Returns
         -------
-        phi(x,y) float.
+        phi(x,y) float or numpy array with the broadcasted shape of x and y.
 
         """
-        
-        phi_well = 0
-        p = self.p
-        for element in self.aem_elements:
-            d = np.abs(self.river_a *element.x + self.river_b*element.y + self.river_c)/np.sqrt(self.river_a**2+ self.river_b**2)
-            if (np.abs(x - element.x) <= element.rw):
-                phi_q = (element.Q/(4*np.pi))*np.log(((x+element.rw -element.x)**2 + (y-element.y)**2)/((x+element.rw-(element.x-2*d- 2*p))**2+(y-element.y)**2))
-            elif (np.abs(y - element.y) <= element.rw):
-                phi_q = (element.Q/(4*np.pi))*np.log(((x - element.x)**2 + (y+element.rw-element.y)**2)/((x-(element.x - 2*d- 2*p))**2+(y+element.rw-element.y)**2))
-            else:
-                phi_q = (element.Q/(4*np.pi))*np.log(((x - element.x)**2 + (y-element.y)**2)/((x-(element.x - 2*d - 2*p))**2+(y-element.y)**2))
-            phi_well += phi_q
-        phi_base = -self.Qo_x*x
-        return self.phi0 + phi_well + phi_base
+        return self._calc_phi(x, y, np.broadcast(x, y).ndim)
+    
+    def _calc_phi(self, x, y, ndim, elements = None):
+        # ndim: number of point axes after the ensemble axes (0: one point per ensemble member)
+        # elements: elements added to the wells (default: all the model elements)
+        phi_well = self.kernel().phi(x, y, *self._ensemble_wells(ndim))
+        phi_base = -self._expand(self.Qo_x, ndim)*np.asarray(x, dtype = float)
+        phi = self._expand(self.phi0, ndim) + phi_well + phi_base
+        for elem in (self.elements if elements is None else elements):
+            phi = phi + elem.phi(x, y)
+        return phi
     
     def calc_head(self,x,y):
         """
         Method to calculate the head at a given location:
         
-        Currently only supports models with default river location (y-axis)
+        Coordinates in the river frame (see to_local)
 
         Parameters
         ----------
-        x,y location of interest.
+        x,y location of interest. Floats or numpy arrays of any (broadcastable) shape.
 
         Returns
         -------
-        head at (x,y): float.
+        head at (x,y): float or numpy array with the broadcasted shape of x and y.
 
         """
         phi = self.calc_phi(x,y) # Discharge potential
-        phicrit = 0.5 * self.k * self.H **2 #Method according to Haijtema, 1995
-        if phi >= phicrit: # Confined conditions
-            h = (phi + 0.5*self.k*self.H**2)/(self.k*self.H)
-        else: # Unconfined conditions
-            h = np.sqrt((2 / self.k) * (phi)) 
-        return h# head
+        return self.head_from_phi(phi) # head
+    
+    def head_from_phi(self, phi):
+        """
+        Converts discharge potential to head (confined or unconfined conditions).
+
+        Parameters
+        ----------
+        phi: discharge potential, float or numpy array.
+
+        Returns
+        -------
+        head: float or numpy array with the shape of phi.
+
+        """
+        k, H = self.k, self.H
+        if self.ensemble_shape != ():
+            ndim = max(np.ndim(phi) - len(self.ensemble_shape), 0)
+            k, H = self._expand(k, ndim), self._expand(H, ndim)
+        return kernels.head_from_phi(phi, k, H) #Method according to Haijtema, 1995
+    
+    def calc_discharge(self, x, y):
+        """
+        Method to calculate the discharge vector (per unit width of aquifer) and the saturated
+        thickness at a given location. The gradient of the potential of all wells, images and the
+        baseflow is calculated analytically, together with the head, in one pass.
+        The specific discharge is (Qx/b, Qy/b).
+        
+        Coordinates in the river frame (see to_local)
+
+        Parameters
+        ----------
+        x,y location of interest. Floats or numpy arrays of any (broadcastable) shape.
+
+        Returns
+        -------
+        Qx, Qy: discharge vector components (-dphi/dx, -dphi/dy)
+        b: saturated thickness (head in unconfined conditions, H in confined conditions)
+        All floats or numpy arrays with the broadcasted shape of x and y.
+
+        """
+        ndim = np.broadcast(x, y).ndim
+        Qo_x = self._expand(self.Qo_x, ndim)
+        Qx, Qy, phi = self.kernel().discharge(x, y, *self._ensemble_wells(ndim))
+        phi = self._expand(self.phi0, ndim) + phi - Qo_x*np.asarray(x, dtype = float)
+        Qx = Qx + Qo_x
+        for elem in self.elements:
+            phi = phi + elem.phi(x, y)
+            Qx_e, Qy_e = elem.discharge(x, y)
+            Qx = Qx + Qx_e
+            Qy = Qy + Qy_e
+        if np.shape(Qy) != np.shape(Qx): # (Qy has no ensemble axes if only the baseflow varies)
+            Qy = np.broadcast_to(Qy, np.shape(Qx)).copy()
+        b = np.minimum(self.head_from_phi(phi), self._expand(self.H, ndim))
+        return Qx[()], Qy[()], b[()]
     
     def calc_psi(self, x,y):
         """
         Method to calculate the stream function for the RBF-AEM model at 
         a given location (x,y)
         
-        Currently only supports models with default river location (y-axis)
+        Coordinates in the river frame (see to_local)
 
         Parameters
         ----------
-        x,y: coordinates of location of interest.
+        x,y: coordinates of location of interest. Floats or numpy arrays of any (broadcastable) shape.
 
         Returns
         -------
-        Stream function (psi) at (x,y): float.
+        Stream function (psi) at (x,y): float or numpy array with the broadcasted shape of x and y.
 
         """
-        psi_well = 0
-        p = self.p
-        for element in self.aem_elements:
-            d = np.abs(self.river_a *element.x + self.river_b*element.y + self.river_c)/np.sqrt(self.river_a**2+ self.river_b**2)
-            if (x == element.x) & (y == element.y):
-                psi_q = (element.Q/(2*np.pi))*(np.arctan2((y-element.y),(x-(element.x+element.rw)))- np.arctan2((y-element.y),(x-(element.x-2*d- 2*p))))
-            else:
-                psi_q = (element.Q/(2*np.pi))*(np.arctan2((y-element.y),(x-element.x))- np.arctan2((y-element.y),(x-(element.x-2*d- 2*p))))
-            psi_well += psi_q
-        psi_base = -self.Qo_x*y
+        ndim = np.broadcast(x, y).ndim
+        psi_well = self.kernel().psi(x, y, *self._ensemble_wells(ndim))
+        psi_base = -self._expand(self.Qo_x, ndim)*np.asarray(y, dtype = float)
         psi = psi_well+psi_base
+        for elem in self.elements:
+            psi = psi + elem.psi(x, y)
         
         
         return psi
     
+    def calc_omega(self, x, y, head = False, dtype = None):
+        """
+        Method to calculate the complex discharge potential Omega = phi + i*psi at a given
+        location. The potential and the stream function are calculated together in one pass
+        with complex logarithms, with the same near-well treatment as calc_phi and calc_psi.
+        
+        Coordinates in the river frame (see to_local)
+
+        Parameters
+        ----------
+        x,y location of interest. Floats or numpy arrays of any (broadcastable) shape.
+        head: boolean, if True the head is also returned.
+        dtype: None (float64) or a reduced precision float type (e.g. numpy.float32) to evaluate
+               in reduced precision (see kernels.omega_reduced), for large maps.
+
+        Returns
+        -------
+        Omega(x,y): complex float or numpy array with the broadcasted shape of x and y.
+        head at (x,y) (only if head is True)
+
+        """
+        if (dtype is not None) and (np.dtype(dtype) != np.float64):
+            return self._calc_omega_reduced(x, y, head, dtype)
+        ndim = np.broadcast(x, y).ndim
+        z = np.asarray(x, dtype = float) + 1j*np.asarray(y, dtype = float)
+        omega = (self._expand(self.phi0, ndim) + self.kernel().omega(x, y, *self._ensemble_wells(ndim))
+                 - self._expand(self.Qo_x, ndim)*z)
+        for elem in self.elements:
+            omega = omega + elem.omega(x, y)
+        if head:
+            return omega[()], self.head_from_phi(omega.real)
+        return omega[()]
+    
+    def _calc_omega_reduced(self, x, y, head, dtype):
+        # calc_omega in reduced precision: coordinates relative to the centroid of the wells,
+        # constant terms summed in float64 before rounding.
+        if self.strip is not None:
+            raise ValueError("Reduced precision is not available for strip aquifers")
+        ndim = np.broadcast(x, y).ndim
+        xw, yw, Q, rw, xi = self._ensemble_wells(ndim)
+        x0 = np.mean(xw) if xw.shape[0] else 0.0
+        y0 = np.mean(yw) if yw.shape[0] else 0.0
+        xr = (np.asarray(x, dtype = float) - x0).astype(dtype)
+        yr = (np.asarray(y, dtype = float) - y0).astype(dtype)
+        phi, psi = kernels.omega_reduced(xr, yr, xw - x0, yw - y0, Q, rw, None if xi is None else xi - x0,
+                                         dtype = dtype)
+        Qo_x, phi0 = self._expand(self.Qo_x, ndim), self._expand(self.phi0, ndim)
+        phi = phi + (np.asarray(phi0 - Qo_x*x0, dtype = dtype) - np.asarray(Qo_x, dtype = dtype)*xr)
+        psi = psi + (np.asarray(-Qo_x*y0, dtype = dtype) - np.asarray(Qo_x, dtype = dtype)*yr)
+        for elem in self.elements: # (evaluated in float64)
+            omega_e = elem.omega(x, y)
+            phi = phi + omega_e.real.astype(dtype)
+            psi = psi + omega_e.imag.astype(dtype)
+        omega = (phi + 1j*psi).astype(np.result_type(dtype, np.complex64))
+        if head:
+            return omega[()], self.head_from_phi(phi)
+        return omega[()]
+    
+    def snapshot(self):
+        """
+        Method to create an immutable copy of the model (parameters and wells) for concurrent
+        evaluation, e.g. from a thread pool while the model is modified (see ModelSnapshot).
+
+        Returns
+        -------
+        ModelSnapshot
+
+        """
+        if self.elements:
+            raise ValueError("Snapshots do not support models with elements other than wells")
+        if self.strip is not None:
+            raise ValueError("Snapshots do not support strip aquifers")
+        wells = self.wells
+        params = {'k': self.k, 'H': self.H, 'h0': self.h0, 'Qo_x': self.Qo_x, 'p': self.p,
+                  'x': self.x, 'y': self.y, 'river_a': self.river_a, 'river_b': self.river_b,
+                  'river_c': self.river_c, 'images': self.images}
+        return ModelSnapshot(params, {'xw': wells.x, 'yw': wells.y, 'Q': wells.Q, 'rw': wells.rw,
+                                      'wellid': wells.wellid},
+                             self.backend, self.farfield_threshold, self.farfield_tol)
+    
+    def plan(self, x, y):
+        """
+        Method to create an evaluation plan for fixed points of interest (monitoring points,
+        transects, grids) evaluated many times with different discharge rates (see plans.py).
+
+        Parameters
+        ----------
+        x,y location of interest. Floats or numpy arrays of any (broadcastable) shape.
+
+        Returns
+        -------
+        plans.EvaluationPlan with the head, psi and discharge methods.
+
+        """
+        if self.ensemble_shape != ():
+            raise ValueError("Evaluation plans do not support ensemble models")
+        if self.elements:
+            raise ValueError("Evaluation plans do not support models with elements other than wells")
+        if self.strip is not None:
+            raise ValueError("Evaluation plans do not support strip aquifers")
+        return plans.EvaluationPlan(self, x, y)
+    
+    def influence(self, x, y):
+        """
+        Method to compute the unit response (influence) matrices of the wells and the baseflow at
+        fixed points, to evaluate heads and stream function for many rates or pumping time series
+        as matrix products (see influence.py).
+
+        Parameters
+        ----------
+        x,y location of interest. Floats or numpy arrays of any (broadcastable) shape.
+
+        Returns
+        -------
+        influence.InfluenceMatrix
+
+        """
+        return influence.InfluenceMatrix.from_model(self, x, y)
+    
+    def transient(self, times = None, Q = None):
+        """
+        Method to evaluate the model wells as transient (Theis) wells, starting to pump at t = 0
+        or following a schedule of rate steps (see transient.py). Needs the storage coefficient S.
+
+        Parameters
+        ----------
+        times: start times of the rate steps (1d array), None: the wells start at t = 0.
+        Q: discharge rate of each well in each step (steps x wells), None: the model rates.
+
+        Returns
+        -------
+        transient.TheisWells with the phi, head, drawdown and stream_depletion methods.
+
+        """
+        return transient.TheisWells(self, times, Q)
+    
     def calc_clogging(self, Kd,d):
         """
         Method to add the clogging effect to the AEM model
@@ -195,18 +782,312 @@ class Model:
         Returns (internal)
         -------
         phi0, float. The reference discharge potential used in the general phi formula.
+        Inside a defer_phi0 block the update is postponed to the end of the block.
 
         """
+        if self._defer_phi0:
+            self._phi0_pending = True
+            return
+        if any(hasattr(elem, 'collocation') for elem in self.elements):
+            self._solve_elements()
+            self._phi0_pending = False
+            return
         
-        self.phi0 = 0
-        
-        phi = self.calc_phi(self.x,self.y)
+        # reference location of each ensemble member (paired with the members, no point axes):
+        shape = self.ensemble_shape
+        x, y = np.broadcast_to(self.x, shape), np.broadcast_to(self.y, shape)
+        phi = self._calc_phi(x, y, 0) - self.phi0 # potential without the reference constant
 
         self.phi0 = self.phi_c - phi
+        self._phi0_pending = False
+    
+    def _solve_elements(self):
+        # Solves the strengths of the head-specified elements and phi0: the potential at the
+        # collocation points of the elements is the specified one, and phi_c at the reference location.
+        # The matrix only depends on the geometry: its LU factorization is cached, so that new
+        # heads or discharge rates only need a new right-hand side.
+        if self.ensemble_shape != ():
+            raise ValueError("Head-specified elements do not support ensemble models")
+        solved = [elem for elem in self.elements if hasattr(elem, 'collocation')]
+        others = [elem for elem in self.elements if not hasattr(elem, 'collocation')]
+        for elem in solved:
+            # on (or near) the line sinks the head at the reference location is fixed twice:
+            if np.any(elem._segment_distance(self.x, self.y) < 0.1*np.abs(elem.z2 - elem.z1)):
+                raise ValueError("The reference location (x_ref, y_ref) is on or near a head-specified "
+                                 "element: move it off the river")
+        points = [elem.collocation() for elem in solved]
+        xs = np.concatenate([pt[0] for pt in points] + [[self.x]])
+        ys = np.concatenate([pt[1] for pt in points] + [[self.y]])
+        key = (tuple(elem.geometry_key() for elem in solved), self.images, self.p,
+               self.river_a, self.river_b, self.river_c, self.x, self.y)
+        if self._lu_key != key:
+            A = np.hstack([elem.unit_omega(xs, ys).real for elem in solved] + [np.ones((xs.shape[0], 1))])
+            self._lu = lu_factor(A)
+            self._lu_key = key
+        target = np.concatenate([pt[2] for pt in points] + [[self.phi_c]])
+        known = self._calc_phi(xs, ys, 1, elements = others) - self.phi0 # wells, baseflow and other elements
+        sol = lu_solve(self._lu, target - known)
+        start = 0
+        for elem in solved:
+            n = elem.Q_segments.shape[0]
+            elem.Q_segments[:] = sol[start:start + n]
+            start += n
+        self.phi0 = sol[-1]
+    
+    @contextlib.contextmanager
+    def defer_phi0(self):
+        """
+        Context manager to postpone update_phi0 until the end of the block, so that many wells
+        can be added with a single update of the reference potential:
+        
+            with model.defer_phi0():
+                for x, y in locations:
+                    Well(model, Q = 100, rw = 0.2, x = x, y = y)
+        
+        """
+        self._defer_phi0 += 1
+        try:
+            yield self
+        finally:
+            self._defer_phi0 -= 1
+            if (self._defer_phi0 == 0) & self._phi0_pending:
+                self.update_phi0()
+    
+    def add_wells(self, x, y = None, Q = None, rw = None):
+        """
+        Method to add many wells to the model at once, with a single update of phi0.
+
+        Parameters
+        ----------
+        x, y: arrays with the well locations, or a pandas DataFrame like well_df (columns X, Y,
+        Discharge and optionally rw) given as x.
+        Q: array (or float) with the discharge rates
+        rw: array (or float) with the well radius
+
+        Returns
+        -------
+        list of the added Well objects.
+
+        """
+        if isinstance(x, pd.DataFrame):
+            df = x
+            x, y, Q = df['X'].to_numpy(), df['Y'].to_numpy(), df['Discharge'].to_numpy()
+            if rw is None:
+                if 'rw' not in df.columns:
+                    raise ValueError("The DataFrame has no rw column: give the well radius with rw")
+                rw = df['rw'].to_numpy()
+        start = self.wells.append(x, y, Q, rw)
+        wells = [Well._from_row(self, index) for index in range(start, len(self.wells))]
+        self.aem_elements.extend(wells)
+        self.update_phi0()
+        return wells
+    
+    def remove_wells(self, wells):
+        """
+        Method to remove wells from the model, with a single update of phi0.
+
+        Parameters
+        ----------
+        wells: Well object or list of Well objects of the model.
+
+        """
+        if isinstance(wells, Well):
+            wells = [wells]
+        removed = np.array(sorted(well.index for well in wells), dtype = np.int64)
+        self.wells.remove(removed)
+        for well in wells:
+            self.aem_elements.remove(well)
+            well.model = None
+        # the rows after the removed wells moved up:
+        for elem in self.aem_elements:
+            if isinstance(elem, Well):
+                elem.index -= int(np.searchsorted(removed, elem.index))
+        self.update_phi0()
+
+def _frozen(value):
+    # hashable version of a parameter (float or array)
+    if np.ndim(value) == 0:
+        return value
+    value = np.asarray(value, dtype = float)
+    return (value.shape, (value + 0).tobytes())
+
+
+class ModelSnapshot:
+    """
+    Immutable copy of an AEM-RBF model (parameters and well table), created with Model.snapshot().
+    
+    The snapshot is hashable and never changes: the "mutation" methods (replace, clogging,
+    with_wells, with_rates) return a new snapshot with its own reference potential phi0.
+    The evaluation methods are the same as in Model (calc_phi, calc_head, calc_psi, calc_omega,
+    calc_discharge), so many concurrent queries can be evaluated from a thread pool without
+    locks (the numpy and numba kernels release the GIL):
+    
+        snap = model.snapshot()
+        with ThreadPoolExecutor() as pool:
+            heads = list(pool.map(lambda xy: snap.calc_head(*xy), transects))
+    
+    Parameters (read-only attributes)
+    --------------------
+    k, H, h0, Qo_x, p : aquifer parameters, baseflow and river clogging factor (see Model)
+    x, y : reference location
+    river_a, river_b, river_c : river line
+    phi_c, phi0 : potential at the reference location and reference constant
+    backend : calculation kernels (kernels.Backend)
+    xw, yw, Q, rw, xi, wellid : read-only well arrays (see Model.well_arrays)
+    """
+    _params = ('k', 'H', 'h0', 'Qo_x', 'p', 'x', 'y', 'river_a', 'river_b', 'river_c', 'images')
+    _wells = ('xw', 'yw', 'Q', 'rw', 'wellid')
+    strip = None # (strip aquifers are not supported)
+    
+    def __init__(self, params, wells, backend, farfield_threshold = None, farfield_tol = 1e-6):
+        set_ = object.__setattr__
+        for name in self._params:
+            value = params[name]
+            if np.ndim(value) > 0:
+                value = np.array(value, dtype = float)
+                value.flags.writeable = False
+            set_(self, name, value)
+        for name in self._wells:
+            column = np.array(wells[name], dtype = np.int64 if name == 'wellid' else float)
+            column.flags.writeable = False
+            set_(self, name, column)
+        set_(self, 'backend', kernels.get_backend(backend))
+        set_(self, 'elements', ()) # (models with elements are not supported)
+        set_(self, 'farfield_threshold', farfield_threshold)
+        set_(self, 'farfield_tol', farfield_tol)
+        # image wells (None without image river):
+        xi = None
+        if self.images:
+            d = np.abs(self.river_a*self.xw + self.river_b*self.yw + self.river_c)/np.sqrt(self.river_a**2 + self.river_b**2)
+            xi = self.xw - 2*d - 2*np.asarray(self.p)[..., np.newaxis]
+            xi.flags.writeable = False
+        set_(self, 'xi', xi)
+        # kernels (the far-field tree is built once here, never while evaluating):
+        kernel = self.backend
+        if self.ensemble_shape != ():
+            kernel = kernels.NUMPY
+        elif (farfield_threshold is not None) and (self.xw.shape[0] > farfield_threshold) and self.images:
+            kernel = farfield.WellTree(*self.well_arrays(), tol = farfield_tol).backend()
+        set_(self, '_kernel', kernel)
+        # reference potential (as Model.update_phi0):
+        phi_c = reference_potential(self.k, self.H, self.h0)
+        shape = self.ensemble_shape
+        set_(self, 'phi_c', phi_c)
+        set_(self, 'phi0', 0)
+        set_(self, 'phi0', phi_c - self._calc_phi(np.broadcast_to(self.x, shape), np.broadcast_to(self.y, shape), 0))
+        set_(self, '_hash', hash(tuple(_frozen(params[name]) for name in self._params) +
+                                 tuple((getattr(self, name) + 0).tobytes() for name in self._wells) +
+                                 (self.backend.name,)))
+    
+    def __setattr__(self, name, value):
+        raise AttributeError("ModelSnapshot is immutable, use replace, with_wells or with_rates")
+    
+    def __delattr__(self, name):
+        raise AttributeError("ModelSnapshot is immutable")
+    
+    def __hash__(self):
+        return self._hash
+    
+    def __eq__(self, other):
+        if not isinstance(other, ModelSnapshot):
+            return NotImplemented
+        return ((self._hash == other._hash) and (self.backend is other.backend) and
+                all(np.array_equal(getattr(self, name), getattr(other, name)) for name in self._params) and
+                all(np.array_equal(getattr(self, name), getattr(other, name)) for name in self._wells))
+    
+    def __len__(self):
+        return self.xw.shape[0]
+    
+    def __repr__(self):
+        return "ModelSnapshot(k={}, H={}, h0={}, Qo_x={}, p={}, wells={})".format(
+            self.k, self.H, self.h0, self.Qo_x, self.p, len(self))
+    
+    def _new(self, params = None, wells = None):
+        # new snapshot with some parameters or well columns changed
+        new_params = {name: getattr(self, name) for name in self._params}
+        new_params.update(params or {})
+        new_wells = {name: getattr(self, name) for name in self._wells}
+        new_wells.update(wells or {})
+        return ModelSnapshot(new_params, new_wells, self.backend, self.farfield_threshold, self.farfield_tol)
+    
+    def replace(self, **params):
+        """
+        Returns a new snapshot with the given parameters changed
+        (k, H, h0, Qo_x, p, x, y, river_a, river_b, river_c).
+        """
+        unknown = set(params) - set(self._params)
+        if unknown:
+            raise ValueError("Unknown model parameters: {}".format(sorted(unknown)))
+        return self._new(params = params)
+    
+    def clogging(self, Kd, d):
+        """
+        Returns a new snapshot with the clogging layer (see Model.calc_clogging).
+        """
+        p = d*self.k/Kd
+        return self._new(params = {'p': p, 'x': 0-p})
+    
+    def with_rates(self, Q):
+        """
+        Returns a new snapshot with the discharge rates Q (float or array, one value per well).
+        """
+        return self._new(wells = {'Q': np.broadcast_to(np.asarray(Q, dtype = float), self.Q.shape)})
+    
+    def with_wells(self, x, y, Q, rw):
+        """
+        Returns a new snapshot with the wells added (floats or 1d arrays of equal length).
+        """
+        x, y, Q, rw = np.broadcast_arrays(*(np.atleast_1d(np.asarray(v, dtype = float)) for v in (x, y, Q, rw)))
+        start = int(self.wellid.max()) + 1 if len(self) else 0
+        wellid = np.arange(start, start + x.shape[0])
+        added = dict(zip(self._wells, (x, y, Q, rw, wellid)))
+        return self._new(wells = {name: np.concatenate((getattr(self, name), added[name])) for name in self._wells})
+    
+    def kernel(self):
+        return self._kernel
+    
+    ensemble_shape = Model.ensemble_shape
+    _expand = Model._expand
+    _ensemble_wells = Model._ensemble_wells
+    
+    def well_arrays(self):
+        """
+        Returns the read-only well arrays xw, yw, Q, rw, xi (see Model.well_arrays).
+        """
+        return self.xw, self.yw, self.Q, self.rw, self.xi
+    
+    # Evaluation methods of Model (they only read the model state):
+    calc_phi = Model.calc_phi
+    _calc_phi = Model._calc_phi
+    calc_head = Model.calc_head
+    head_from_phi = Model.head_from_phi
+    calc_discharge = Model.calc_discharge
+    calc_psi = Model.calc_psi
+    calc_omega = Model.calc_omega
+    _calc_omega_reduced = Model._calc_omega_reduced
+
+
+class _WellColumn:
+    """
+    Descriptor exposing one column of the model well table as a Well attribute.
+    """
+    def __init__(self, name):
+        self.name = name
+    
+    def __get__(self, well, owner = None):
+        if well is None:
+            return self
+        return well.model.wells.column(self.name)[well.index]
+    
+    def __set__(self, well, value):
+        well.model.wells.set_column(self.name, value, well.index)
+
 
 class Well:
     """
     Element to create Well for the AEM-RBF model
+    The well parameters are stored in the model well table (model.wells), the Well object
+    is a handle to its row in the table.
     Inputs to the well object:
     --------------------------
         model : a AEM-RBF model
@@ -215,14 +1096,258 @@ class Well:
         x: x-location of the well
         y: y-location of the well
     """
+    x = _WellColumn('x')
+    y = _WellColumn('y')
+    Q = _WellColumn('Q')
+    rw = _WellColumn('rw')
+    
     def __init__(self, model,Q, rw, x,y):
+        self.model = model
+        self.index = model.wells.append(x, y, Q, rw)
+        model.aem_elements.append(self)
+        model.update_phi0()
+    
+    @classmethod
+    def _from_row(cls, model, index):
+        """
+        Creates the handle for a well already stored in the model well table.
+        """
+        well = cls.__new__(cls)
+        well.model = model
+        well.index = index
+        return well
+    
+    @property
+    def wellid(self):
+        return self.model.wells.wellid[self.index]
+    
+    def distance(self, x, y):
+        """
+        Distance from the points (x, y) to the well center (floats or arrays).
+        """
+        return np.hypot(np.asarray(x, dtype = float) - self.x, np.asarray(y, dtype = float) - self.y)[()]
+
+
+class _LineSinks:
+    """
+    Base of the elements made of uniform line sinks (segments z1 -> z2 with discharge Q),
+    with images across the river line of the model (as the image wells) if model.images is True.
+    The subclasses set model, z1, z2 and Q_segments (discharge of each segment).
+    """
+    def __len__(self):
+        return self.z1.shape[0]
+    
+    def geometry_key(self):
+        return (self.z1.tobytes(), self.z2.tobytes())
+    
+    def _images(self):
+        # end points of the image segments (across the river line, as the image wells)
+        m = self.model
+        if np.ndim(m.p) > 0:
+            raise ValueError("Line sink elements do not support ensembles of p")
+        norm = np.sqrt(m.river_a**2 + m.river_b**2)
+        images = []
+        for z in (self.z1, self.z2):
+            d = np.abs(m.river_a*z.real + m.river_b*z.imag + m.river_c)/norm
+            images.append(z.real - 2*d - 2*m.p + 1j*z.imag)
+        return images
+    
+    def unit_omega(self, x, y):
+        """
+        Complex potential of each segment (and its image) for unit discharge.
+
+        Returns
+        -------
+        complex array with the broadcasted shape of x and y and a trailing axis for the segments.
+
+        """
+        omega = kernels.linesink_omega(x, y, self.z1, self.z2)
+        if self.model.images:
+            omega -= kernels.linesink_omega(x, y, *self._images())
+        return omega
+    
+    def omega(self, x, y):
+        return self.unit_omega(x, y) @ self.Q_segments
+    
+    def phi(self, x, y):
+        return np.real(self.omega(x, y))
+    
+    def psi(self, x, y):
+        return np.imag(self.omega(x, y))
+    
+    def discharge(self, x, y):
+        """
+        Discharge vector of the element (Qx, Qy), floats or arrays with the broadcasted shape of x and y.
+        """
+        Qx, Qy = kernels.linesink_discharge(x, y, self.z1, self.z2)
+        if self.model.images:
+            Qx_i, Qy_i = kernels.linesink_discharge(x, y, *self._images())
+            Qx, Qy = Qx - Qx_i, Qy - Qy_i
+        return (Qx @ self.Q_segments)[()], (Qy @ self.Q_segments)[()]
+    
+    def _segment_distance(self, x, y):
+        # distance from the points (x, y) to each segment (trailing axis)
+        x, y = kernels._points(x, y)
+        z = x + 1j*y
+        t = np.clip(((z - self.z1)*np.conj(self.z2 - self.z1)).real/np.abs(self.z2 - self.z1)**2, 0, 1)
+        return np.abs(z - (self.z1 + t*(self.z2 - self.z1)))
+    
+    def distance(self, x, y):
+        """
+        Distance from the points (x, y) to the segments (floats or arrays).
+        """
+        return np.min(self._segment_distance(x, y), axis = -1)[()]
+
+
+class LineSinkRiver(_LineSinks):
+    """
+    Head-specified river element: a string of line sinks through the vertices (x, y), for river
+    reaches that are not straight (e.g. meanders near the wells). The discharge of each segment
+    is solved (Model.update_phi0) so that the head at the segment centers is the river stage,
+    together with phi0. The system matrix only depends on the geometry: its factorization is
+    cached by the model, changing the stage or the pumping rates only needs a new solution.
+    
+    With the image river of the model (model.images True) each segment has an image across the
+    river line; set model.images = False for models where this element is the only river.
+    The reference location of the model (x_ref, y_ref, where the head is h0) must be off the
+    river: farther from each segment than a tenth of its length (e.g. x_ref = 500 for a river
+    along the y-axis). On the river the collocation system is
+    singular, and update_phi0 raises ValueError.
+    
+    Inputs to the river object:
+    --------------------------
+        model : a AEM-RBF model
+        x, y: coordinates of the vertices (river frame of the model), 1d arrays (n + 1 vertices)
+        head: river stage (head measured from the base of the aquifer), float or one value per
+              segment (n). After changing it, call model.update_phi0().
+    
+    Attributes
+    --------------------
+    Q_segments : discharge of each segment (positive: the river gains water from the aquifer)
+    """
+    def __init__(self, model, x, y, head):
+        self.model = model
+        self.x = np.asarray(x, dtype = float)
+        self.y = np.asarray(y, dtype = float)
+        z = self.x + 1j*self.y
+        self.z1 = z[:-1]
+        self.z2 = z[1:]
+        self.head = head
+        self.Q_segments = np.zeros(self.z1.shape[0])
+        model.elements.append(self)
+        model.aem_elements.append(self)
+        model.update_phi0()
+    
+    def collocation(self):
+        """
+        Returns the collocation points (segment centers) and the specified potential there.
+        """
+        m = self.model
+        zc = 0.5*(self.z1 + self.z2)
+        phi = reference_potential(m.k, m.H, np.broadcast_to(self.head, zc.shape))
+        return zc.real, zc.imag, phi
+
+
+class CollectorWell(_LineSinks):
+    """
+    Element to create a horizontal collector (Ranney) well for the AEM-RBF model.
+    Each lateral is a uniform line sink (closed-form potential, stream function and discharge),
+    with its image across the river like the image of a Well. The discharge of the well is
+    distributed among the laterals proportionally to their length (uniform inflow per unit length).
+    Inputs to the collector well object:
+    --------------------------
+        model : a AEM-RBF model
+        Q: total discharge rate (positive for extraction). After changing it, call model.update_phi0().
+        x, y: location of the center of the caisson
+        lengths: length of each lateral (float or array)
+        angles: direction of each lateral, in degrees counterclockwise from the x-axis (array)
+        rc: radius of the caisson (the laterals start at the caisson wall)
+        rw: radius of the laterals (particle tracking stops close to the laterals)
+    """
+    def __init__(self, model, Q, x, y, lengths, angles, rc = 0.0, rw = 0.1):
+        self.model = model
         self.x = x
         self.y = y
-        self.Q = Q
+        self.rc = rc
         self.rw = rw
+        lengths, angles = np.broadcast_arrays(np.atleast_1d(np.asarray(lengths, dtype = float)),
+                                              np.deg2rad(np.atleast_1d(np.asarray(angles, dtype = float))))
+        direction = np.exp(1j*angles)
+        self.z1 = (x + 1j*y) + rc*direction
+        self.z2 = self.z1 + lengths*direction
+        self.lengths = lengths
+        self.Q = Q
+        model.elements.append(self)
         model.aem_elements.append(self)
         model.update_phi0()
+    
+    @property
+    def Q_segments(self):
+        # discharge of each lateral
+        return self.Q*self.lengths/np.sum(self.lengths)
 
 
-
-
+class WellGallery:
+    """
+    Element to create a gallery of wells for the AEM-RBF model: an infinite row of equally spaced
+    wells parallel to the river (the y-axis), each with the same discharge, and their images.
+    The row is evaluated in closed form (see kernels.gallery_omega), at the cost of one well.
+    Inputs to the gallery object:
+    --------------------------
+        model : a AEM-RBF model
+        Q: discharge rate of each well. After changing it, call model.update_phi0().
+        rw: radius of the wells
+        x: x-location of the gallery
+        y: y-location of one of the wells
+        spacing: distance between the wells
+    """
+    def __init__(self, model, Q, rw, x, y, spacing):
+        self.model = model
+        self.Q = Q
+        self.rw = rw
+        self.x = x
+        self.y = y
+        self.spacing = spacing
+        model.elements.append(self)
+        model.aem_elements.append(self)
+        model.update_phi0()
+    
+    @property
+    def d(self):
+        # distance from the gallery to the river line
+        m = self.model
+        return np.abs(m.river_a*self.x + m.river_b*self.y + m.river_c)/np.sqrt(m.river_a**2 + m.river_b**2)
+    
+    @property
+    def xi(self):
+        # x-location of the image gallery (None without image river)
+        m = self.model
+        if not m.images:
+            return None
+        if np.ndim(m.p) > 0:
+            raise ValueError("WellGallery does not support ensembles of p")
+        return self.x - 2*self.d - 2*m.p
+    
+    def omega(self, x, y):
+        return self.Q*kernels.gallery_omega(x, y, self.x, self.y, self.rw, self.xi, self.spacing)[..., 0][()]
+    
+    def phi(self, x, y):
+        return np.real(self.omega(x, y))
+    
+    def psi(self, x, y):
+        return np.imag(self.omega(x, y))
+    
+    def discharge(self, x, y):
+        """
+        Discharge vector of the gallery (Qx, Qy), floats or arrays with the broadcasted shape of x and y.
+        """
+        Qx, Qy = kernels.gallery_discharge(x, y, self.x, self.y, self.xi, self.spacing)
+        return self.Q*Qx[..., 0][()], self.Q*Qy[..., 0][()]
+    
+    def distance(self, x, y):
+        """
+        Distance from the points (x, y) to the closest well of the gallery (floats or arrays).
+        """
+        a = self.spacing
+        dy = (np.asarray(y, dtype = float) - self.y + 0.5*a) % a - 0.5*a
+        return np.hypot(np.asarray(x, dtype = float) - self.x, dy)[()]
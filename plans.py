@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Evaluation plans of the AEM-RBF model for fixed sets of points.
+
+Workflows that evaluate the same points (monitoring wells, transects, plot grids) many times
+while only the pumping rates or the baseflow change can use a plan (Model.plan) instead of
+the calc_* methods. The plan precomputes, for each point and well, the complex potential of the
+well + image pair for unit discharge (the log of distances and the angles, with the near-well
+treatment of kernels.omega_pairs). Each evaluation is then a matrix-vector product with the
+discharge rates, written into preallocated workspaces:
+
+    plan = model.plan(xs, ys)
+    for Q in schedule:
+        h = plan.head(Q)
+
+The plan takes k, H, h0, Qo_x and the reference location from the model at each call, and is
+rebuilt automatically when wells are added or moved, or the image geometry changes (river line,
+clogging factor). The model discharge rates are used unless Q is given.
+
+Memory: 2 x (points x wells) float64 matrices (4 after the first call to discharge).
+"""
+import numpy as np
+
+import kernels
+
+
+class EvaluationPlan:
+    """
+    Precomputed evaluation of a model at fixed points (see Model.plan).
+
+    Inputs:
+    --------------------------
+        model: AEM-RBF model
+        x, y: coordinates of the points, floats or numpy arrays of any (broadcastable) shape.
+
+    The arrays returned by head, psi and discharge are views of the plan workspaces, with the
+    broadcasted shape of x and y: they are overwritten by the next call to the same method
+    (copy them to keep the results).
+    """
+    def __init__(self, model, x, y):
+        self.model = model
+        x, y = np.broadcast_arrays(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+        self.shape = x.shape
+        self.x = np.array(x).ravel()
+        self.y = np.array(y).ravel()
+        n = self.x.shape[0]
+        # Workspaces:
+        self._phi = np.empty(n)
+        self._tmp = np.empty(n)
+        self._confined = np.empty(n, dtype = bool)
+        self._h = np.empty(n)
+        self._psi = np.empty(n)
+        self._qx = np.empty(n)
+        self._qy = np.empty(n)
+        self._b = np.empty(n)
+        self._key = None
+        self.update()
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def update(self):
+        """
+        Recalculates the unit pair potentials if the well geometry changed since the plan was built.
+        """
+        m = self.model
+        xw, yw, Q, rw, xi = m.well_arrays() # updates the image geometry first
+        key = (m.wells.geometry_version, m.x, m.y)
+        if key == self._key:
+            return
+        pairs = kernels.omega_pairs(self.x, self.y, xw, yw, rw, xi)/(2*np.pi)
+        self.A_phi = np.ascontiguousarray(pairs.real)
+        self.A_psi = np.ascontiguousarray(pairs.imag)
+        del pairs
+        self.a_ref = kernels.omega_pairs(m.x, m.y, xw, yw, rw, xi).real/(2*np.pi)
+        self.G_x = self.G_y = None # discharge matrices, built on first use
+        self._key = key
+
+    def _rates(self, Q):
+        self.update()
+        if Q is None:
+            return self.model.wells.Q
+        return np.asarray(Q, dtype = float)
+
+    def _potential(self, Q):
+        # discharge potential at the points into the phi workspace
+        m = self.model
+        phi = np.dot(self.A_phi, Q, out = self._phi)
+        # reference potential for these rates (as in Model.update_phi0):
+        phi0 = m.phi_c - (np.dot(self.a_ref, Q) - m.Qo_x*m.x)
+        np.multiply(self.x, -m.Qo_x, out = self._tmp)
+        phi += self._tmp
+        phi += phi0
+        return phi
+
+    def _head(self, phi, out):
+        # head from the potential, in place (as Model.head_from_phi)
+        m = self.model
+        np.greater_equal(phi, 0.5*m.k*m.H**2, out = self._confined)
+        np.multiply(phi, 2/m.k, out = out)
+        np.sqrt(out, out = out)
+        np.multiply(phi, 1/(m.k*m.H), out = out, where = self._confined)
+        np.add(out, 0.5*m.H, out = out, where = self._confined)
+        return out
+
+    def head(self, Q = None):
+        """
+        Heads at the plan points.
+
+        Parameters
+        ----------
+        Q: array with the discharge rate of each well (model well table order).
+           None: the current model discharge rates.
+
+        Returns
+        -------
+        head: numpy array with the shape of the points (plan workspace).
+
+        """
+        Q = self._rates(Q)
+        return self._head(self._potential(Q), self._h).reshape(self.shape)
+
+    def phi(self, Q = None):
+        """
+        Discharge potential at the plan points (plan workspace, see head).
+        """
+        return self._potential(self._rates(Q)).reshape(self.shape)
+
+    def psi(self, Q = None):
+        """
+        Stream function at the plan points (plan workspace, see head).
+        """
+        Q = self._rates(Q)
+        psi = np.dot(self.A_psi, Q, out = self._psi)
+        np.multiply(self.y, -self.model.Qo_x, out = self._tmp)
+        psi += self._tmp
+        return psi.reshape(self.shape)
+
+    def discharge(self, Q = None):
+        """
+        Discharge vector and saturated thickness at the plan points (as Model.calc_discharge).
+
+        Parameters
+        ----------
+        Q: array with the discharge rate of each well, None: the current model discharge rates.
+
+        Returns
+        -------
+        Qx, Qy: discharge vector components
+        b: saturated thickness
+        numpy arrays with the shape of the points (plan workspaces).
+
+        """
+        Q = self._rates(Q)
+        if self.G_x is None:
+            xw, yw, _, rw, xi = self.model.well_arrays()
+            self.G_x, self.G_y = (np.ascontiguousarray(g) for g in kernels.discharge_pairs(self.x, self.y, xw, yw, xi))
+        qx = np.dot(self.G_x, Q, out = self._qx)
+        qx += self.model.Qo_x
+        qy = np.dot(self.G_y, Q, out = self._qy)
+        b = self._head(self._potential(Q), self._b)
+        np.minimum(b, self.model.H, out = b)
+        return qx.reshape(self.shape), qy.reshape(self.shape), b.reshape(self.shape)
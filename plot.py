@@ -11,47 +11,83 @@ import matplotlib.pyplot as plt
 from matplotlib import cm
 from matplotlib.ticker import StrMethodFormatter
 
+import grid
+
 
 class plotting:
     """
     Class to assist in plotting of the AEM model
+    (the grid is in the river frame of the model, see model_proposal.River)
     Input:
     xmin,xmax
     river coordinates = [riv y-min, riv y-max],
     steps
+    workers: number of processes to evaluate the grid (see grid.evaluate_grid), default: serial
+    reuse_plan: if True, the grid is evaluated with an evaluation plan (see plans.py) kept between
+                calls, faster when plotting the same model many times with different pumping rates.
+                The arrays returned by fix_to_mesh are then overwritten by the next call.
+    incremental: if True, the grid keeps one layer per well (see grid.WellLayers), so that after adding,
+                 removing or moving wells only their layers are recomputed (interactive sessions).
     """
-    def __init__(self,xmin, xmax, ymin, ymax, steps, riv_coords = None):
+    def __init__(self,xmin, xmax, ymin, ymax, steps, riv_coords = None, workers = None, reuse_plan = False,
+                 incremental = False):
         self.xmin=xmin
         self.ymin=ymin
         self.xmax=xmax
         self.ymax=ymax
         self.steps=steps
         self.riv_coords=riv_coords
+        self.workers=workers
+        self.reuse_plan=reuse_plan
+        self._plan=None
+        self.incremental=incremental
+        self._layers=None
         
-    def mesh(self):
+    def vectors(self):
         
-        # Method to create the plot grid:
+        # Method to create the x and y coordinates of the plot grid (1d arrays):
         
         xvec=np.linspace(self.xmin, self.xmax, self.steps)
         yvec = np.linspace(self.ymin, self.ymax, self.steps)
-        xvec, yvec = np.meshgrid(xvec,yvec)
         return xvec, yvec
     
+    def mesh(self, sparse = False):
+        
+        # Method to create the plot grid (sparse: broadcastable (1,n) and (n,1) arrays):
+        
+        xvec, yvec = np.meshgrid(*self.vectors(), sparse = sparse)
+        return xvec, yvec
+    
+    def plan(self, model):
+        
+        # Method to get the evaluation plan of the plot grid (kept while the model is the same):
+        
+        if (self._plan is None) or (self._plan.model is not model):
+            self._plan = model.plan(*self.mesh(sparse = True))
+        return self._plan
+    
     def fix_to_mesh(self,model):
         
         # Method to export results to the plot grid:
         
-        hl=[]
-        psil=[]
-        for x,y in zip(self.mesh()[0].flatten(),self.mesh()[1].flatten()):
-            head = model.calc_head(x, y)
-            psi_0 = model.calc_psi(x, y)
-            hl.append(head)
-            psil.append(psi_0)
-        h= np.array(hl).reshape((self.steps,self.steps))
-        psi=np.array(psil).reshape((self.steps,self.steps))
+        if self.incremental:
+            if (self._layers is None) or (self._layers.model is not model):
+                self._layers = grid.WellLayers(model, *self.vectors())
+            return self._layers.evaluate()
+        if self.reuse_plan:
+            plan = self.plan(model)
+            return plan.head(), plan.psi()
+        h, psi = grid.evaluate_grid(model, *self.vectors(), workers = self.workers)
         return h , psi
     
+    def stream_to_mesh(self, model, h_path, psi_path, block_rows = 64):
+        """
+        Method to export results to the plot grid without keeping them in memory.
+        Generator that writes the heads and the stream function to .npy files (see grid.stream_grid),
+        yielding the (row0, row1) range of each evaluated block of rows.
+        """
+        return grid.stream_grid(model, *self.vectors(), h_path, psi_path, block_rows = block_rows)
+    
     def plot2d(self,model,tt=None, ys = None, traj_array = None, levels=10, alpha=0.6, quiver=False, streams=False, figsize = (18,12)):
         """
         Method to plot results in 2D. Support the plotting of time of travel (Inputs to the time of travel
@@ -66,15 +102,19 @@ class plotting:
         figsize (tuple, 2d): 2d dimensions of the image.
         """
         
-        h=self.fix_to_mesh(model)[0]
-        psi=self.fix_to_mesh(model)[1]
+        h, psi = self.fix_to_mesh(model)
+        xvec, yvec = self.vectors()
         
-        # Calculating gradients for quiver: 
-        dy, dx = np.gradient(-h)
+        # Specific discharge for quiver and streamplot: 
+        if self.reuse_plan:
+            Qx, Qy, b = self.plan(model).discharge()
+        else:
+            Qx, Qy, b = model.calc_discharge(*self.mesh(sparse = True))
+        dx, dy = Qx/b, Qy/b
         e=1
         
         fig, ax = plt.subplots(1,2,figsize = figsize , sharey = True, gridspec_kw={'width_ratios': [1, 3.5]})
-        contour = plt.contourf(self.mesh()[0], self.mesh()[1], h,
+        contour = plt.contourf(xvec, yvec, h,
             levels,
             cmap = cm.Blues,alpha=alpha)
         ax[1].set_xlabel('x [m]')
@@ -83,17 +123,17 @@ class plotting:
         fig.colorbar(contour, ax=ax[1], shrink=0.9)
         
         if not (quiver) and not(streams) and (traj_array==None):
-            ax[1].contour(self.mesh()[0], self.mesh()[1],psi,
+            ax[1].contour(xvec, yvec,psi,
                                       int(levels*2.5),
                                       colors=('#848482',),
                                       linewidths=(1,))
         elif quiver:
             
-            ax[1].quiver(self.mesh()[0][::e,::e], self.mesh()[1][::e,::e], 
+            ax[1].quiver(xvec[::e], yvec[::e], 
                          dx[::e,::e], dy[::e,::e], 
                          linewidths=0.1, alpha=0.5,width=0.001)
         if streams:
-            ax[1].streamplot(self.mesh()[0][::e,::e], self.mesh()[1][::e,::e], 
+            ax[1].streamplot(xvec[::e], yvec[::e], 
                              dx[::e,::e], dy[::e,::e], color='#4169e1', 
                               linewidth=0.8, density=0.6,arrowsize=1.2,zorder=0)
             
@@ -102,7 +142,7 @@ class plotting:
                 ax[1].plot(trajectory[0,:],trajectory[1,:],linestyle = '--', 
                            linewidth=2.8, color = "maroon", label = "particle trajectory")
         
-        ax[1].plot([0,0],[np.min(self.mesh()[1]),np.max(self.mesh()[1])], 
+        ax[1].plot([0,0],[np.min(yvec),np.max(yvec)], 
                    color = '#4169e1', linestyle = '-', linewidth = 20) #river line
         if self.riv_coords is not None:
             ax[1].plot([0, 0], [self.riv_coords[0], self.riv_coords[1]], 
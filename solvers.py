@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 """
 Script with the solvers implemented in the RBF model.
-This initial implementation is based on automatic root finding from the sympy package.
+The river length of a single well is solved in closed form (the stagnation points on the river
+line are the roots of a quadratic in y); other cases use numerical root finding.
 
 Current implementations:
     
@@ -9,22 +10,62 @@ Current implementations:
         This is the length of the river intercepted by the rbf well
     - Stream flow contribution:
         This is the percentage of the pumping discharge that comes from river water.
+    - River length and stream flow contribution of each well of a well gallery (closed form).
+    - Wellfields: river intervals captured by many wells, total river-water contribution and the
+      river water attributed to each well (river_length.solve_wellfield_length).
+    - solve_river_length_batch: river length and stream flow contribution for arrays of cases
+      (screening tables), vectorized, with a mask of the cases without stagnation points.
     - Travel time:
         Calculate the travel time of particles that infiltrate from the river to the well.
         
 Limitations:
-    - Streams must be located in the y-axis
-    - Only one well allowed, located in the positive x,y quadrant
+    - Streams must be located in the y-axis: the solvers work in the river frame of the model
+      (see model_proposal.River); results can be transformed back with model.to_global
+    - solve_river_length and time_travel: one well (Well or CollectorWell) on the aquifer side of
+      the river (x > 0); models with many wells use solve_wellfield_length, well galleries
+      solve_gallery_length
+    - Strip aquifers (Model.strip) and collector wells: the river length is solved numerically
+      (root finding on the river line) instead of with the closed-form equation of a single well
+      in a semi-infinite aquifer
+    - Models with other elements (e.g. a LineSinkRiver as the only river, model.images False):
+      no river length; time_travel takes the starting points of the particles instead
 
 @author: vcant
 """
 import numpy as np
-import sympy
 import itertools
-from scipy.optimize import fsolve
+from scipy.integrate import quad
+from scipy.optimize import brentq, fsolve
+
+import kernels
+from model_proposal import CollectorWell, Well, WellGallery
 
 #For the time of travel calculation using ttcrpy package:
 
+_POINT_WELLS = 64 # maximum number of wells for the scalar evaluation in time_travel
+
+def _point_functions(model):
+    # Specific discharge and stream function of a model with wells only at single points, from
+    # the scalar kernels (python floats). For one point the numpy model methods cost more in
+    # overhead than in arithmetic, and the tracking loop of time_travel calls them at every step
+    # and fsolve iteration. Returns None if the model needs the general methods.
+    if ((model.ensemble_shape != ()) or model.elements or (model.strip is not None) or
+            (not model.images) or (len(model.wells) > _POINT_WELLS)):
+        return None
+    xw, yw, Q, rw, xi = (c.tolist() for c in model.well_arrays())
+    phi0, Qo_x, k, H = float(model.phi0), float(model.Qo_x), float(model.k), float(model.H)
+    
+    def specific_discharge(x, y):
+        Qx, Qy = kernels.discharge_point(x, y, xw, yw, Q, xi, True)
+        phi = phi0 + kernels.phi_point(x, y, xw, yw, Q, rw, xi, True) - Qo_x*x
+        b = min(kernels.head_point(phi, k, H), H)
+        return (Qx + Qo_x)/b, Qy/b
+    
+    def psi(x, y):
+        return kernels.psi_point(x, y, xw, yw, Q, rw, xi, True) - Qo_x*y
+    
+    return specific_discharge, psi
+
 
 class river_length():
     """
@@ -36,10 +77,12 @@ class river_length():
             This is the length of the river intercepted by the rbf well
         - Stream flow contribution:
             This is the percentage of the pumping discharge that comes from river water.
+        - Well galleries (solve_gallery_length) and wellfields of many wells (solve_wellfield_length).
         
     Limitations:
-        - Streams must be located in the y-axis
-        - Only one well allowed, located in the positive x,y quadrant
+        - Streams must be located in the y-axis (river frame of the model)
+        - solve_river_length and time_travel: one well (Well or CollectorWell) on the aquifer side
+          of the river (x > 0)
         
     Inputs:
         Model: The RBF model class, already set up with the aquifer characteristics and the well placement.
@@ -48,6 +91,11 @@ class river_length():
     def __init__(self, model):
         self.model = model
     
+    def _pumping_element(self):
+        # The well (Well or CollectorWell) of the model, None if there is not exactly one
+        wells = [elem for elem in self.model.aem_elements if isinstance(elem, (Well, CollectorWell))]
+        return wells[0] if len(wells) == 1 else None
+    
     def solve_river_length(self):
         """
         Method to calculate intercepted river length and river-flow contribution to well discharge.
@@ -59,69 +107,446 @@ class river_length():
 
         Returns
         -------
-        length: river length intercepted by the well
+        length: river length intercepted by the well (inf without baseflow, Qo_x = 0: the well
+                takes water along the whole river)
         sol_el: location of the river legnth (y-coordinates of the intercepted river length)
         contrib: contribution of river-water to discharge: the percentage of the pumping-rate that comes from river water (the rest is aquifer water)
 
         """
-        if (len(self.model.aem_elements) > 1) | (len(self.model.aem_elements) == 0):
-            return "Failed to derive solution. Check current implementation limitiations or model mistakes./nHave you added exactly one well to your model?"
+        elem = self._pumping_element()
+        if (elem is None) or (len(self.model.aem_elements) > 1) or not self.model.images:
+            return "Failed to derive solution. Check current implementation limitiations or model mistakes./nHave you added exactly one well (or collector well) to your model?"
         else:
             
-            y = sympy.symbols('y')
-            elem = self.model.aem_elements[0]
             Q = elem.Q
-            xw = elem.x
             yw = elem.y
-            d = np.abs(self.model.river_a *xw + self.model.river_b*yw + self.model.river_c)/np.sqrt(self.model.river_a**2+ self.model.river_b**2)
             Qx = -self.model.Qo_x
             p = self.model.p
-      
-            ## Checking if stagnation points exists for the solution:
-            ex_st_points = Q/(np.pi*d*Qx)
             
-            if ex_st_points <= 1:
-                return print("There are no stagnation points, check model inputs")
+            if (self.model.strip is not None) or not isinstance(elem, Well) or (Qx == 0):
+                # strip aquifers, collector wells and models without baseflow: the stagnation points
+                # are found numerically on the river line
+                sol_el = self._river_stagnation(-p, yw)
+                if sol_el is None:
+                    return print("There are no stagnation points, check model inputs")
+            else:
+                ## Stagnation points on the river line (x = -p), relative to the well:
+                ## -(d+p)**2 + (d+p)*Q/(pi*Qx) - y**2 = 0
+                d = self.model.image_geometry()[0][elem.index]
+                D = d + p
+                y2 = D*Q/(np.pi*Qx) - D**2
+                if y2 <= 0:
+                    return print("There are no stagnation points, check model inputs")
+                half = np.sqrt(np.float64(y2))
+                sol_el = [yw - half, yw + half] # Correcting the solution to the well y position
+            length = np.abs(sol_el[0]-sol_el[1]) # River capture  length
+            if isinstance(elem, Well) and np.isfinite(length):
+                psi = self.model.calc_psi(0, np.array(sol_el))
+                Q_river = psi[0] - psi[1] + Q
             else:
-                equation = sympy.Eq(-(d+p)**2 + (d+p)*Q/(np.pi*Qx)-y**2,0) # Equation assumes the well is at y = 0, it is corrected later below.
-                sols = sympy.solveset(equation, y, domain = sympy.S.Reals)
-                sol_el = []
-                for i in sols: #Transforming solution that is in a set to a list
-                    sol_el.append(np.float64(i+yw)) # Correcting the solution to the well y position
-                length = np.abs(sol_el[0]-sol_el[1]) # River capture  length
-                Q_river = self.model.calc_psi(0,sol_el[0]) - self.model.calc_psi(0,sol_el[1])+ Q
-                contrib = Q_river/Q
+                # inflow across the river line (the stream function of the laterals has branch
+                # cuts along their extension, which can cross the river line)
+                Q_river = quad(lambda y: self.model.calc_discharge(-p, y)[0], sol_el[0], sol_el[1],
+                               epsabs = 1e-10*abs(Q), limit = 200)[0]
+            contrib = Q_river/Q
             
-                return length,sol_el, contrib
+            return length,sol_el, contrib
+    
+    def _river_stagnation(self, x, yw):
+        # Stagnation points on the river line x (strip aquifers, collector wells): the discharge normal to the
+        # river (Qx, positive towards the aquifer) is zero at both ends of the intercepted length.
+        # Returns None if the well does not take river water, and [-inf, inf] if it takes water
+        # along the whole river: far from the well Qx is the baseflow Qo_x.
+        def Qx(y):
+            return self.model.calc_discharge(x, y)[0]
+        if (Qx(yw) <= 0) or (self.model.Qo_x > 0):
+            return None
+        if self.model.Qo_x == 0:
+            return [-np.inf, np.inf]
+        sol_el = []
+        for direction in (-1, 1):
+            step = max(abs(x), 1.0)
+            while Qx(yw + direction*step) > 0:
+                step *= 2
+            sol_el.append(brentq(Qx, yw, yw + direction*step, xtol = 1e-10))
+        return sol_el
+    
+    def solve_gallery_length(self):
+        """
+        Method to calculate the intercepted river length and river-flow contribution to the discharge
+        of each well of a well gallery (model with one WellGallery element and the baseflow), in closed form.
+        
+        The discharge towards the aquifer across the river line (x = -p) of the gallery and its image is
+        Qx(y) = (Q/a) sinh(2 pi D/a)/(cosh(2 pi D/a) - cos(2 pi (y - yw)/a)), D = d + p, a: spacing.
+        The river water enters where Qx > -Qo_x: the capture length follows from the value of
+        cos(2 pi (y - yw)/a) where both are equal, and the river inflow from the integral of Qx
+        (arctan-tan primitive).
+
+        Returns
+        -------
+        length: river length intercepted by each well of the gallery (the spacing without
+                baseflow, Qo_x = 0: contrib is 1)
+        sol_el: location of the river length of the gallery well at y (y-coordinates)
+        contrib: contribution of river-water to the discharge of each well (fraction of Q)
+
+        """
+        elements = self.model.aem_elements
+        if (len(elements) != 1) or not isinstance(elements[0], WellGallery):
+            return "Failed to derive solution. Check current implementation limitiations or model mistakes./nHave you added exactly one well gallery to your model?"
+        gallery = elements[0]
+        Q = gallery.Q
+        a = gallery.spacing
+        D = gallery.d + self.model.p
+        Qx = -self.model.Qo_x
+        if Qx == 0:
+            # without baseflow all the water comes from the river, each well takes its spacing
+            return float(a), [gallery.y - a/2, gallery.y + a/2], 1.0
+        S, C = np.sinh(2*np.pi*D/a), np.cosh(2*np.pi*D/a)
+        # cos(2 pi (y - yw)/a) at the edges of the intercepted length:
+        cos_edge = C - Q*S/(a*Qx)
+        if cos_edge >= 1:
+            return print("There are no stagnation points, check model inputs")
+        half = np.arccos(max(cos_edge, -1))*a/(2*np.pi) # whole river captured if cos_edge <= -1
+        sol_el = [gallery.y - half, gallery.y + half]
+        length = 2*half
+        # river inflow: integral of Qx - (-Qo_x) over the intercepted length
+        Q_river = (2*Q/np.pi)*np.arctan(np.tan(np.pi*half/a)/np.tanh(np.pi*D/a)) - Qx*length
+        contrib = Q_river/Q
+        return length, sol_el, contrib
     
-    def time_travel(self, ne, delta_s = 0.1, calculate_trajectory = False, min_dist_est = 0.1):
+    def solve_wellfield_length(self, tol = 1e-4, max_steps = 2000):
+        """
+        Method to calculate the river intervals captured by the wells of a wellfield (model with any
+        number of wells and the baseflow), the river-water contribution to the total discharge and
+        the river water attributed to each well.
+        
+        The stream function along the river line (x = -p) is, without the branch cuts of the wells,
+        psi(y) = -sum(Q/pi*arctan((y - yw)/(d + p))) - Qo_x*y: the river water enters the aquifer
+        where Qx = -dpsi/dy > 0. The ends of these intervals (stagnation points on the river) are
+        bracketed on nodes around each well and refined with brentq.
+        The river water entering an interval is split between the wells (or returns to the river)
+        by the dividing streamlines, which end at the stagnation points of the flow: the saddles in
+        the aquifer (roots of Qx - iQy = -dOmega/dz, see _stagnation_points) and the ends of the
+        intervals. The dividing streamlines are traced back from them to the river (two from each
+        saddle, one from each end of an interval: 2 per well in total), and the divides on the river
+        are refined to the psi of their stagnation point. The water on either side of a dividing
+        streamline leaves the stagnation point along the outgoing streamline on that side, which is
+        traced forward to its well (2 per well as well): each part between divides is labelled from
+        the divides around it, and traced from its middle only if they disagree.
+        The particles take embedded Runge-Kutta steps (Dormand-Prince) with an error below tol
+        times the step length. The river water of each well is the difference of psi over its
+        captured intervals.
+        
+        The cost grows with the number of particles (4 per well) times the number of wells summed
+        at every step: 5 to 40 wells take about 20 to 50 ms, 160 wells about 0.4 s and 320 wells
+        about 2 s. The fractions of wells a metre or less apart may exceed 1 by about tol. The
+        closed-form solvers (solve_river_length, solve_gallery_length, solve_river_length_batch)
+        are the fast paths.
+
+        Parameters
+        ----------
+        tol: tolerance of the interval ends and divides, relative to the smallest distance of the wells
+             to the river, and of the tracing error per unit length of the paths
+        max_steps: maximum number of tracing steps
+
+        Returns
+        -------
+        intervals: numpy array (intervals x 2), y-coordinates of the captured river intervals (lower end first)
+        wells: numpy array (intervals), index of the capturing well (well table order)
+        contrib: contribution of river-water to the total discharge of the wells (fraction)
+        well_contrib: numpy array (wells), contribution of river-water to the discharge of each well
+                      (fraction of its Q, nan for wells with Q <= 0)
+
+        """
+        m = self.model
+        if (m.ensemble_shape != ()) or m.elements or (m.strip is not None) or not m.images:
+            raise ValueError("solve_wellfield_length needs a model with wells only and the image river "
+                             "(no ensembles, elements or strips)")
+        if not np.all(m.Qo_x < 0):
+            raise ValueError("solve_wellfield_length needs a baseflow towards the river (Qo_x < 0)")
+        xw, yw, Q, rw, xi = m.well_arrays()
+        x0 = -m.p # river line of the image wells
+        D = xw - x0
+        scale = np.min(D)
+        
+        def psi_river(y):
+            y = np.asarray(y, dtype = float)[..., np.newaxis]
+            return -np.sum((Q/np.pi)*np.arctan((y - yw)/D), axis = -1) + (-m.Qo_x)*y[..., 0]
+        
+        def Qx_river(y):
+            y = np.asarray(y, dtype = float)[..., np.newaxis]
+            return np.sum((Q/np.pi)*D/(D**2 + (y - yw)**2), axis = -1) + m.Qo_x
+        
+        # Nodes: around each well (spacing proportional to d + p) and beyond the reach of all
+        # wells, where sum(Q*D/(pi*dy**2)) < -Qo_x:
+        reach = np.sqrt(np.sum(np.maximum(Q, 0)*D)/(np.pi*(-m.Qo_x))) + scale
+        t = np.tan(np.linspace(-1.5, 1.5, 64))
+        nodes = np.unique(np.concatenate(((yw[:, np.newaxis] + D[:, np.newaxis]*t).ravel(),
+                                          [yw.min() - reach, yw.max() + reach])))
+        positive = Qx_river(nodes) > 0
+        changes = np.flatnonzero(positive[1:] != positive[:-1])
+        ends = np.array([brentq(Qx_river, nodes[i], nodes[i + 1], xtol = 1e-9*scale) for i in changes])
+        if (ends.shape[0] == 0) or not np.any(Q > 0):
+            return np.empty((0, 2)), np.empty(0, dtype = int), 0.0, np.where(Q > 0, 0.0, np.nan)
+        # infiltration intervals (the first end is where Qx becomes positive)
+        infiltration = ends.reshape(-1, 2)
+        
+        # Dividing streamlines: they arrive at the saddles from two opposite directions, and at the
+        # ends of the intervals from the aquifer, along the directions e where the velocity
+        # conj(dW/dz*e) points back to the stagnation point: e**2 = -conj(dW/dz)/|dW/dz|.
+        # The water leaves the stagnation points along i*e (perpendicular at the saddles, at 45
+        # degrees from the river at the ends).
+        z, dW = self._stagnation_points()
+        saddles = z.real > x0 + tol*scale
+        n = np.count_nonzero(saddles)
+        z = np.concatenate((z[saddles], x0 + 1j*ends))
+        dW = np.concatenate((dW[saddles], self._stagnation_points(x0 + 1j*ends)[1]))
+        e = np.sqrt(-np.conj(dW)/np.abs(dW))
+        e = np.where(e.real < 0, -e, e) # (into the aquifer at the river)
+        out = np.concatenate((-1j*e[:n], 1j*e[:n], np.where((1j*e[n:]).real < 0, -1j*e[n:], 1j*e[n:])))
+        zo = np.concatenate((z[:n], z))
+        dest = self._trace_wells(x0, zo.real + tol*scale*out.real, zo.imag + tol*scale*out.imag,
+                                 max_steps, tol, scale)[0]
+        # the water next to a dividing streamline follows it, and leaves the stagnation point along
+        # the branch on its side: left (-i*e) and right (+i*e) of the flow. At the ends, the water on
+        # the other side goes back to the river (-1). On the river, the left side is above (y).
+        at_end = dest[2*n:]
+        end_left = out[2*n:] == -1j*e[n:]
+        left = np.concatenate((dest[:n], dest[n:2*n], np.where(end_left, at_end, -1)))
+        right = np.concatenate((dest[n:2*n], dest[:n], np.where(end_left, -1, at_end)))
+        e = np.concatenate((e[:n], -e[:n], e[n:]))
+        z = np.concatenate((z[:n], z))
+        labels, y, jump = self._trace_wells(x0, z.real + tol*scale*e.real, z.imag + tol*scale*e.imag,
+                                            max_steps, tol, scale, backward = True)
+        river = labels == -1
+        y, z, jump, left, right = y[river], z[river], jump[river], left[river], right[river]
+        # The stream function is constant along the streamlines: the divides are refined (Newton) to
+        # psi_river(y) = psi(z) + jump, with the branch cuts of the model psi on the river line
+        # (psi = psi_river + sum(Q/2*sign(y - yw))).
+        target = m.calc_psi(z.real, z.imag) + jump - np.sum(0.5*Q*np.sign(y[:, np.newaxis] - yw), axis = 1)
+        divides = y
+        for iteration in range(8):
+            divides = divides + (psi_river(divides) - target)/Qx_river(divides)
+        # (if a crossing was missed, e.g. next to a well, psi differs by a discharge: traced divides)
+        missed = np.abs(psi_river(y) - target) > 0.25*np.min(np.abs(Q[Q != 0]))
+        divides = np.where(missed, y, divides)
+        order = np.argsort(divides)
+        divides, left, right = divides[order], left[order], right[order]
+        # parts of the infiltration intervals between divides, labelled from the divide (or end of
+        # the interval) below and the one above; where they disagree (e.g. a streamline from one
+        # saddle to another), the well is traced from the middle of the part.
+        parts = []
+        for (lo, hi), above, below in zip(infiltration, at_end[0::2], at_end[1::2]):
+            inside = (divides > lo) & (divides < hi)
+            bounds = np.concatenate(([lo], divides[inside], [hi]))
+            parts.append((bounds[:-1], bounds[1:], np.append(above, left[inside]), np.append(right[inside], below)))
+        lo, hi, from_lo, from_hi = (np.concatenate(v) for v in zip(*parts))
+        keep = hi > lo
+        lo, hi, from_lo, from_hi = lo[keep], hi[keep], from_lo[keep], from_hi[keep]
+        dest = from_lo
+        check = (from_lo != from_hi) | (from_lo == -2)
+        if np.any(check):
+            dest[check] = self._trace_wells(x0, np.full(np.count_nonzero(check), x0), 0.5*(lo[check] + hi[check]),
+                                            max_steps, tol, scale)[0]
+        # parts of an interval next to each other captured by the same well are joined:
+        first = np.flatnonzero(np.append(True, (dest[1:] != dest[:-1]) | (lo[1:] != hi[:-1])))
+        last = np.append(first[1:], dest.shape[0]) - 1
+        captured = dest[first] >= 0
+        intervals = np.column_stack((lo[first], hi[last]))[captured]
+        wells = dest[first][captured]
+        # river water of each interval (psi difference) and of each well:
+        Q_river = psi_river(intervals[:, 0]) - psi_river(intervals[:, 1])
+        well_river = np.bincount(wells, weights = Q_river, minlength = Q.shape[0])
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            well_contrib = np.where(Q > 0, well_river/Q, np.nan)
+        contrib = np.sum(Q_river)/np.sum(Q[Q > 0])
+        return intervals, wells, contrib, well_contrib
+    
+    def _stagnation_points(self, z = None):
+        # Stagnation points of the wells, their images and the baseflow: roots of the complex discharge
+        # W(z) = Qx - iQy = Qo_x - sum(Q/(2 pi)*(zw - zi)/((z - zw)*(z - zi))). They are the 2n roots
+        # of the polynomial P(z) = W(z)*prod((z - zw)*(z - zi)) (n wells with Q != 0), found all at
+        # once with Aberth iterations on the rational form (P'/P = W'/W + sum(1/(z - zw) + 1/(z - zi))),
+        # without the coefficients of P. They come in pairs mirrored by the river line (or on it).
+        # Returns the roots and dW/dz at them (or at the given points z).
+        m = self.model
+        xw, yw, Q, rw, xi = m.well_arrays()
+        pumping = Q != 0
+        c = Q[pumping]/(2*np.pi)
+        zw, zi = xw[pumping] + 1j*yw[pumping], xi[pumping] + 1j*yw[pumping]
+        
+        def dW_dz(z):
+            z = z[:, np.newaxis]
+            return np.sum(c*(1/(z - zw)**2 - 1/(z - zi)**2), axis = 1)
+        
+        if z is not None:
+            return z, dW_dz(np.asarray(z, dtype = complex))
+        n = c.shape[0]
+        if n == 0:
+            return np.empty(0, dtype = complex), np.empty(0, dtype = complex)
+        # starting points around the wells and the images (not mirrored, distinct)
+        D = (zw - zi).real/2
+        angle = 2*np.pi*(np.arange(2*n) + 0.25)/(2*n)
+        z = np.concatenate((zw, zi)) + np.concatenate((D, D))*0.5*np.exp(1j*(angle + 0.4))
+        scale = np.min(D)
+        for iteration in range(200):
+            dz = z[:, np.newaxis]
+            r, ri = 1/(dz - zw), 1/(dz - zi)
+            W = m.Qo_x - np.sum(c*(zw - zi)*r*ri, axis = 1)
+            Wp = np.sum(c*(r**2 - ri**2), axis = 1)
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                newton = 1/(Wp/W + np.sum(r + ri, axis = 1))
+                others = 1/(dz - z)
+                np.fill_diagonal(others, 0)
+                step = newton/(1 - newton*np.sum(others, axis = 1))
+            step = np.where(np.isfinite(step), step, 0) # (at a root)
+            z = z - step
+            if np.max(np.abs(step)) <= 1e-13*scale:
+                break
+        return z, dW_dz(z)
+    
+    def _trace_wells(self, x0, x, y, max_steps, tol, scale, backward = False):
+        # Traces particles from (x, y) along the discharge direction (or against it, backward) with
+        # embedded Runge-Kutta steps (Dormand-Prince 5(4)): the error estimate of each step is kept
+        # below tol times the step length, which is at most 1/2 of the distance to the closest well
+        # and, towards the river, 1/2 of the distance to the river line x0 (steps shorter than
+        # tol*scale are accepted, e.g. at stagnation points). The streamlines cross the river line
+        # at right angles (Qy = 0 on it): a particle within tol*scale of it, moving towards it,
+        # reaches it at its y coordinate.
+        # A well (extraction, or injection backward) takes the particles where its own radial flow,
+        # Q/(2 pi r), is more than twice the rest of the discharge, within half the distance to the
+        # other wells and images: all the streamlines there go to the well (a fixed radius, e.g. 5 rw,
+        # would also take the streamlines that pass next to a small well on their way to another).
+        # Returns the labels: the index of the well that takes the particle, -1 if it reaches the river, -3 if it goes (backward) beyond
+        # the reach of the wells, where the flow is always towards the river, -2 if unresolved;
+        # the y coordinates of the particles at the end; and the jump of the stream function of
+        # the model along each path (+-Q for each crossing of the branch cut of a well, y = yw
+        # between the river and the well), so that psi(end) = psi(start) + jump on a streamline.
+        m = self.model
+        xw, yw, Q, rw, xi = m.well_arrays()
+        sign = -1.0 if backward else 1.0
+        poles = np.flatnonzero(Q != 0)
+        xs, ys_s, c = xw[poles], yw[poles], sign*Q[poles]/(2*np.pi)
+        takes = c > 0
+        # half the distance of each well to the closest other well or image:
+        others = np.hypot(xs[:, np.newaxis] - np.append(xs, xi[poles]), ys_s[:, np.newaxis] - np.append(ys_s, ys_s))
+        np.fill_diagonal(others, np.inf)
+        r_trap = 0.5*np.min(others, axis = 1)
+        # beyond x_far the wells change the discharge by less than the baseflow (|dW| < 2Q D/(2 pi r**2))
+        x_far = np.max(xw) + np.sqrt(np.sum(np.abs(Q)*(xw - x0))/(np.pi*np.abs(m.Qo_x)))
+        x = np.array(x, dtype = float)
+        y = np.array(y, dtype = float)
+        ds = np.full(y.shape, np.inf)
+        labels = np.full(y.shape, -2)
+        jump = np.zeros(y.shape)
+        active = np.arange(y.shape[0])
+        # Dormand-Prince coefficients (the last stage is at the 5th order solution) and the
+        # difference of the 5th and 4th order weights (error estimate):
+        A = [[1/5], [3/40, 9/40], [44/45, -56/15, 32/9], [19372/6561, -25360/2187, 64448/6561, -212/729],
+             [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+             [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+        E = [71/57600, 0, -71/16695, 71/1920, -17253/339200, 22/525, -1/40]
+        
+        def direction(x, y):
+            # unit vector of the tracing direction and the magnitude of the discharge
+            gx, gy = kernels.discharge_pairs(x, y, xw, yw, xi)
+            Qx, Qy = gx @ Q + m.Qo_x, gy @ Q
+            q = np.hypot(Qx, Qy)
+            q_ = sign*np.where(q != 0, q, 1)
+            return Qx/q_, Qy/q_, q
+        
+        # direction and discharge at the particles (last stage of the previous step)
+        ux, uy, speed = direction(x, y)
+        for step in range(max_steps):
+            if active.shape[0] == 0:
+                break
+            xa, ya = x[active], y[active]
+            dx, dy = xa[:, np.newaxis] - xs, ya[:, np.newaxis] - ys_s
+            dist = np.hypot(dx, dy)
+            j = np.argmin(np.where(takes, dist, np.inf), axis = 1, keepdims = True)
+            r = np.take_along_axis(dist, j, axis = 1)[:, 0]
+            own = c[j[:, 0]]/r # (radial, towards the well)
+            rest = np.hypot(speed[active]*ux[active] + own*np.take_along_axis(dx, j, axis = 1)[:, 0]/r,
+                            speed[active]*uy[active] + own*np.take_along_axis(dy, j, axis = 1)[:, 0]/r)
+            captured = takes[j[:, 0]] & (r <= r_trap[j[:, 0]]) & (own > 2*rest)
+            river = (xa - x0 <= tol*scale) & (ux[active] < 0)
+            far = xa > x_far
+            labels[active[captured]] = poles[j[captured, 0]]
+            labels[active[river & ~captured]] = -1
+            labels[active[far]] = -3
+            keep = ~(captured | river | far)
+            active, xa, ya, dist = active[keep], xa[keep], ya[keep], dist[keep]
+            h = np.minimum(ds[active], 0.5*np.min(dist, axis = 1, initial = np.inf))
+            h = np.where(ux[active] < 0, np.minimum(h, np.maximum(0.5*(xa - x0), tol*scale)), h)
+            kx, ky = [ux[active]], [uy[active]]
+            for row in A:
+                px = xa + h*sum(a*k for a, k in zip(row, kx))
+                py = ya + h*sum(a*k for a, k in zip(row, ky))
+                u, v, q = direction(px, py)
+                kx.append(u)
+                ky.append(v)
+            err = h*np.hypot(sum(e*k for e, k in zip(E, kx)), sum(e*k for e, k in zip(E, ky)))
+            ok = (err <= tol*h) | (h <= tol*scale) # (rejected steps are repeated with a shorter step)
+            moved = active[ok]
+            # branch cuts crossed by the step (the angle of the well goes from pi to -pi downwards):
+            dy0, dy1 = ya[ok, np.newaxis] - ys_s, py[ok, np.newaxis] - ys_s
+            with np.errstate(divide = 'ignore', invalid = 'ignore'):
+                xc = xa[ok, np.newaxis] + (px - xa)[ok, np.newaxis]*dy0/(dy0 - dy1)
+            cut = (np.sign(dy0) != np.sign(dy1)) & (xc < xs)
+            jump[moved] += np.sum(np.where(cut, np.sign(dy1 - dy0)*Q[poles], 0), axis = 1)
+            x[moved], y[moved] = px[ok], py[ok]
+            ux[moved], uy[moved], speed[moved] = kx[-1][ok], ky[-1][ok], q[ok]
+            with np.errstate(divide = 'ignore'):
+                factor = np.clip(0.9*(tol*h/err)**0.25, 0.2, 5)
+            ds[active] = h*factor
+        return labels, y, jump
+    
+    def time_travel(self, ne, delta_s = 0.1, calculate_trajectory = False, min_dist_est = 0.1, starts = None,
+                    max_steps = 100000):
         """
         Method to derive the time of travel of selected paths from the river to the well.
         The algorithm is a numerical integration of the travel paths of 20 sampled particles
-        located at the river intersection.
+        located at the river intersection (or of particles starting at the given points).
         It calculate the travel time of each particle, the flux average travel time and the 
         minimum travel time.
         
         Optionally it calculates the particle trajectories, although that is not an efficient algorithm
         
+        Each step is corrected so that the particle stays on its streamline (stream function of the
+        starting point). In models with elements (e.g. collector wells, line sink rivers) the stream
+        function has branch cuts along the extension of the line sinks, where that correction would
+        move the particle to another streamline: the steps use the mean of the velocities at both
+        ends of the predicted step instead (Heun).
+        
         Requires:
-        Successful run of the solve river length method
+        Successful run of the solve river length method, or the starting points
+        
+        Inputs
+        -------
+        starts: None (default, particles along the intercepted river length) or the starting
+                points of the particles (xs, ys), e.g. on a LineSinkRiver for models where
+                solve_river_length is not available. The particles go to the well (Well or
+                CollectorWell) of the model.
+        max_steps: maximum number of steps of each particle (as the compiled tracker)
 
         Returns
         -------
         tt: time of travel array : numpy array, dimensions: (length of river capture length,1)
-        ys: y position array: numpy array with the river y position of the start of the particle
+        ys: y position array: numpy array with the river y position of the start of the particle (y of the starting points)
         avgtt (float): flux averaged time of travel calculated as: sum(t_x*qx)/sum(qx)
         mintt (float): minimum time of travel (min(tt))
         traj_array (list[particle index] of numpy array [2xn]: x[0] and y[1] position of particle in time): trajectory of each particle used for plotting.
 
         """
         
-        length, sol_el, contrib = self.solve_river_length()
-        
-        ys = np.linspace(sol_el[0]+min_dist_est,sol_el[1]-min_dist_est,20)
-        #print(ys.shape)
-        xs = np.repeat(0.1,ys.shape[0])
+        if starts is None:
+            length, sol_el, contrib = self.solve_river_length()
+            
+            ys = np.linspace(sol_el[0]+min_dist_est,sol_el[1]-min_dist_est,20)
+            #print(ys.shape)
+            xs = np.repeat(0.1,ys.shape[0])
+        else:
+            xs, ys = (np.asarray(v, dtype = float).ravel() for v in np.broadcast_arrays(*starts))
         tt = []
         if calculate_trajectory:
             traj_array = []
@@ -130,155 +555,147 @@ class river_length():
         initial parameters from the model:
             
         '''
-        elem = self.model.aem_elements[0]
-        Q = elem.Q
+        elem = self._pumping_element()
+        if elem is None:
+            raise ValueError("time_travel needs exactly one well (Well or CollectorWell) in the model")
         xw = elem.x
         yw = elem.y
-        d = np.abs(self.model.river_a *xw + self.model.river_b*yw + self.model.river_c)/np.sqrt(self.model.river_a**2+ self.model.river_b**2)
-        Qx = self.model.Qo_x
         rw = elem.rw
-        p = self.model.p
         
         '''
-        general qx, qy formulas (general potential)
+        specific discharge from the model discharge vector (general potential)
         '''
-        def qx(x,y, Q, Qx, xw, yw, d, p):
-            head = self.model.calc_head(x,y)
-            
-            #Checking if confined or unconfined: (improv. possible)
-            if head > self.model.H:
-                z = self.model.H
-            else:
-                z = head
-            
-            #Specific discharge calculation
-            return -1*(-Qx + Q/(4*np.pi)*((2*(x-xw)/((x-xw)**2+(y-yw)**2))-(2*(x-(xw-2*d-2*p)))/((x-(xw-2*d-2*p))**2+(y-yw)**2)))/z
+        def specific_discharge(x, y):
+            Qx, Qy, z = self.model.calc_discharge(x, y) # z: saturated thickness
+            return Qx/z, Qy/z
         
-        def qy(x,y, Q, Qx, xw, yw, d, p):
-            head = self.model.calc_head(x,y)
-            
-            #Checking if confined or unconfined:
-            if head > self.model.H:
-                z = self.model.H
-            else:
-                z = head
-            
-            #Specific discharge calculation
-            return -1*(Q/(4*np.pi)*((2*(y-yw)/((x-xw)**2+(y-yw)**2))-(2*(y-yw))/((x-(xw-2*d-2*p))**2+(y-yw)**2)))/z
+        calc_psi = self.model.calc_psi
+        step_discharge = specific_discharge
+        point = _point_functions(self.model)
+        if point is not None: # scalar evaluation in the tracking loop
+            step_discharge, calc_psi = point
         
         '''
-        Formulas for correction of the trajectory (stream function)
-        (This has to be improved to a more general case...)
+        Formulas for correction of the trajectory (stream function), fsolve gives 1-element arrays
         '''
-        def equation_x(x_a, psi, y_2, Q, Qx, xw, yw, d, p):
-                    return -Qx*y_2 + (Q/(2*np.pi))*(np.arctan2((y_2-yw),(x_a-xw))- np.arctan2((y_2-yw),(x_a-(xw-2*d-2*p))))-psi
+        def equation_x(x_a, psi, y_2):
+                    return calc_psi(float(x_a[0]), y_2) - psi
+        
+        def equation_y(y_a, psi, x_2) :
+                    return calc_psi(x_2, float(y_a[0])) - psi
         
-        def equation_y(y_a, psi, x_2, Q, Qx, xw, yw, d, p) :
-                    return -Qx*y_a + (Q/(2*np.pi))*(np.arctan2((y_a-yw),(x_2-xw))- np.arctan2((y_a-yw),(x_2-(xw-2*d-2*p))))-psi
         ''' 
         calculation of streamline and time of travel
         '''
-        for x,y in zip(xs,ys):
+        track = self.model.backend.track
+        if (track is not None) and not self.model.elements and (self.model.strip is None):
+            # Compiled particle tracking (see kernels.py for the tolerance with respect to the loop below)
+            model = self.model
+            tt, traj_array = track(xs, ys, ne, delta_s, xw, yw, 5*rw, rw, *model.well_arrays(),
+                                   model.phi0, model.Qo_x, model.k, model.H, max_steps = max_steps,
+                                   trajectory = calculate_trajectory)
+        else:
+            streamline = not self.model.elements # (stream function correction of the steps)
+            for x,y in zip(xs,ys):
             
-            # Starting the trajectory arrays if necessary:
-            if calculate_trajectory:
-                xss = []
-                xss.append(x)
-                yss = []
-                yss.append(y)
+                # Starting the trajectory arrays if necessary:
+                if calculate_trajectory:
+                    xss = []
+                    xss.append(x)
+                    yss = []
+                    yss.append(y)
             
-            #dis_arr = [] #error checking
-            #v_arr = [] #error checking
-            t_arr = []
-            x1 = x
-            y1 = y
-            psi = self.model.calc_psi(x,y)
-            breakin_dists = []
-            while np.sqrt((x1-xw)**2+(y1-yw)**2) > 5*rw :
-                #Part 1 calculating velocity:
-                dista1 = np.sqrt((x1-xw)**2+(y1-yw)**2)
-                #print(x1)
-                #print(y1)
-                qx1 = qx(x1,y1, Q, Qx, xw, yw, d, p)
-                qy1 = qy(x1,y1, Q, Qx, xw, yw, d, p)
-                vx = qx1/ne
-                vy = qy1/ne
-                v_i = np.sqrt(vx**2+vy**2)
+                #dis_arr = [] #error checking
+                #v_arr = [] #error checking
+                t_arr = []
+                x1 = x
+                y1 = y
+                psi = calc_psi(float(x), float(y))
+                breakin_dists = []
+                while (elem.distance(x1, y1) > 5*rw) and (len(t_arr) < max_steps): # (distance to the well, or to the laterals of a collector well)
+                    #Part 1 calculating velocity:
+                    #print(x1)
+                    #print(y1)
+                    qx1, qy1 = step_discharge(x1, y1)
+                    vx = qx1/ne
+                    vy = qy1/ne
+                    v_i = np.sqrt(vx**2+vy**2)
                 
                 
-                #Part 2: estimating second point
+                    #Part 2: estimating second point
                 
                 
-                y_2 = np.float(y1 + delta_s*vy/v_i)
-                x_2 = np.float(x1 + delta_s*vx/v_i)
+                    y_2 = float(y1 + delta_s*vy/v_i)
+                    x_2 = float(x1 + delta_s*vx/v_i)
                 
-                if np.sqrt((x_2-xw)**2+(y_2-yw)**2) < rw:
-                    break
+                    if elem.distance(x_2, y_2) < rw:
+                        break
                 
-                ## correcting the point location based on the psi value:
+                    ## correcting the point location based on the psi value:
                 
-                if vx > vy :
-                    sols_y = fsolve(equation_y, y_2, (psi, x_2, Q, Qx, xw, yw, d, p), xtol = 1e-4)
-                    sol_el_y = sols_y[0]
-                    y_2 = sol_el_y
-                else:
-                    sols = fsolve(equation_x, x_2, (psi, y_2, Q, Qx, xw, yw, d, p), xtol = 1e-4)
-                    sol_el_x = sols[0]
-                    x_2 = sol_el_x
+                    if not streamline:
+                        # Heun step: mean velocity of the predicted step
+                        qx2, qy2 = step_discharge(x_2, y_2)
+                        vxm = 0.5*(vx + qx2/ne)
+                        vym = 0.5*(vy + qy2/ne)
+                        vm = np.sqrt(vxm**2+vym**2)
+                        y_2 = float(y1 + delta_s*vym/vm)
+                        x_2 = float(x1 + delta_s*vxm/vm)
+                    elif abs(vx) > abs(vy):
+                        sols_y = fsolve(equation_y, y_2, (psi, x_2), xtol = 1e-4)
+                        sol_el_y = sols_y[0]
+                        y_2 = sol_el_y
+                    else:
+                        sols = fsolve(equation_x, x_2, (psi, y_2), xtol = 1e-4)
+                        sol_el_x = sols[0]
+                        x_2 = sol_el_x
                 
-                ## Calculating distance:
-                dist = np.sqrt((x_2-x1)**2+(y_2-y1)**2)
+                    ## Calculating distance:
+                    dist = np.sqrt((x_2-x1)**2+(y_2-y1)**2)
                 
-                # Calculating velocities for the second point:
+                    # Calculating velocities for the second point:
                 
-                qx2 = qx(x_2,y_2, Q, Qx, xw, yw, d, p)
-                qy2 = qy(x_2,y_2, Q, Qx, xw, yw, d, p)
-                vx2 = qx2/ne
-                vy2 = qy2/ne
+                    qx2, qy2 = step_discharge(x_2, y_2)
+                    vx2 = qx2/ne
+                    vy2 = qy2/ne
                 
-                # Calculating mean velocity: 
+                    # Calculating mean velocity: 
                 
-                vxm = np.mean([vx,vx2])
-                vym = np.mean([vy,vy2])
+                    vxm = np.mean([vx,vx2])
+                    vym = np.mean([vy,vy2])
                 
-                vm = np.sqrt(vxm**2+vym**2)
+                    vm = np.sqrt(vxm**2+vym**2)
                 
-                #Calculating time of travel of the particle (deltaS/deltaV) and appending to array:
-                t_arr.append(dist/vm)
-                #dis_arr.append(dist) #error checking
-                #v_arr.append(vm)
+                    #Calculating time of travel of the particle (deltaS/deltaV) and appending to array:
+                    t_arr.append(dist/vm)
+                    #dis_arr.append(dist) #error checking
+                    #v_arr.append(vm)
                 
-                #Looping
-                x1 = x_2
-                y1 = y_2
+                    #Looping
+                    x1 = x_2
+                    y1 = y_2
                 
-                if calculate_trajectory:
-                    xss.append(x1)
-                    yss.append(y1)
+                    if calculate_trajectory:
+                        xss.append(x1)
+                        yss.append(y1)
 
             
-            #Adding time of travel estimate
-            #dis_arr = np.array(dis_arr)
-            #v_arr = np.array(v_arr)
-            tt.append(np.sum(np.array(t_arr)))
+                #Adding time of travel estimate
+                #dis_arr = np.array(dis_arr)
+                #v_arr = np.array(v_arr)
+                tt.append(np.sum(np.array(t_arr)))
             
-            # Saving the particle trajectory in a numpy array:
-            if calculate_trajectory:
-                traj_arr = np.vstack((np.array(xss),np.array(yss)))
-                traj_array.append(traj_arr)
+                # Saving the particle trajectory in a numpy array:
+                if calculate_trajectory:
+                    traj_arr = np.vstack((np.array(xss),np.array(yss)))
+                    traj_array.append(traj_arr)
             
         
         #Return the average travel time:
         
         ## Calculate qxs (specific discharges):
-        qs = []
-        for x,y in zip(xs,ys):
-            qx1 = qx(x,y, Q, Qx, xw, yw, d, p)
-            qy1 = qy(x,y, Q, Qx, xw, yw, d, p)
-            q = np.sqrt(qx1**2+qy1**2)
-            qs.append(q)
-        
-        qs = np.array(qs)
+        qx1, qy1 = specific_discharge(xs, ys)
+        qs = np.sqrt(qx1**2+qy1**2)
         tt = np.array(tt)
         ## Calulcate average traveltime:
         avgtt = np.sum(qs*tt)/np.sum(qs)
@@ -310,3 +727,56 @@ class river_length():
 
 
 
+
+
+def solve_river_length_batch(Q, xw, yw = 0, Qo_x = -1, p = 0):
+    """
+    Vectorized river_length.solve_river_length for arrays of cases (one well and the baseflow,
+    river on the y-axis), e.g. screening tables over pumping rates, well distances, baseflows and
+    clogging factors. The capture length does not depend on k, H or h0 (only through p).
+    
+    The stagnation points on the river line (x = -p) are the roots of
+    -(d+p)**2 + (d+p)*Q/(pi*Qx) - (y - yw)**2 = 0 (Qx = -Qo_x), and the river-water contribution
+    is calculated from the stream function at x = 0, both in closed form as in solve_river_length.
+
+    Parameters
+    ----------
+    Q: discharge rate of the well (positive for extraction)
+    xw, yw: well coordinates (xw: distance to the river)
+    Qo_x: baseflow (negative: towards the river)
+    p: river clogging factor
+    Floats or numpy arrays of any (broadcastable) shape.
+
+    Returns
+    -------
+    length: river length intercepted by the well
+    sol_el: y-coordinates of the ends of the intercepted river length (shape + (2,), lower end first)
+    contrib: contribution of river-water to the discharge (fraction of Q)
+    valid: boolean array, False where there are no stagnation points (Q/(pi*(d+p)*Qx) <= 1),
+           the other results are nan there. Without baseflow (Qo_x = 0, Q > 0) the well takes
+           water along the whole river: length inf, sol_el (-inf, inf) and contrib 1.
+    All numpy arrays with the broadcasted shape of the parameters.
+
+    """
+    Q, xw, yw, Qo_x, p = np.broadcast_arrays(*(np.asarray(v, dtype = float) for v in (Q, xw, yw, Qo_x, p)))
+    Qx = -Qo_x
+    D = xw + p
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        y2 = D*Q/(np.pi*Qx) - D**2
+        valid = (y2 > 0) & (Qx != 0) # (Qx = 0: see below)
+        half = np.sqrt(np.where(valid, y2, np.nan))
+        length = 2*half
+        sol_el = np.stack((yw - half, yw + half), axis = -1)
+        # stream function of the well + image (xi = -xw - 2p) and the baseflow at x = 0, y = yw -+ half:
+        xi = -xw - 2*p
+        psi = ((Q/(2*np.pi))[..., np.newaxis]*(np.arctan2(sol_el - yw[..., np.newaxis], -xw[..., np.newaxis]) -
+                                                np.arctan2(sol_el - yw[..., np.newaxis], -xi[..., np.newaxis]))
+               - Qo_x[..., np.newaxis]*sol_el)
+        contrib = (psi[..., 0] - psi[..., 1] + Q)/Q
+    # without baseflow the well takes water along the whole river (as solve_river_length):
+    whole = (Qo_x == 0) & (Q > 0)
+    valid = valid | whole
+    length = np.where(whole, np.inf, length)
+    sol_el = np.where(whole[..., np.newaxis], [-np.inf, np.inf], sol_el)
+    contrib = np.where(whole, 1.0, contrib)
+    return length, sol_el, contrib, valid
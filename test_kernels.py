@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""
+Comparison of the calculation kernels with the numpy reference (kernels.NUMPY), with the
+tolerances documented in kernels.py:
+
+    - numba backend: phi, psi, omega and discharge (with and without image river) and the
+      particle tracking of river_length.time_travel
+    - far-field tree (farfield.WellTree): phi and psi within Model.farfield_tol
+    - reduced precision (Model.calc_omega with dtype = numpy.float32)
+
+Run with pytest, or as a script (python test_kernels.py). The numba comparisons are skipped
+if numba is not installed.
+"""
+import unittest
+import numpy as np
+
+import kernels
+import model_proposal
+import solvers
+
+try:
+    import kernels_numba
+except ImportError:
+    kernels_numba = None
+
+
+def _needs_numba():
+    if kernels_numba is None:
+        raise unittest.SkipTest("numba is not installed")
+
+
+def _wellfield(n = 40, seed = 0):
+    # wells along a reach of the river, and points around them (some at the well locations)
+    rng = np.random.default_rng(seed)
+    model = model_proposal.Model(k = 10, H = 20, h0 = 15)
+    model.Qo_x = -0.5
+    model.add_wells(rng.uniform(20, 150, n), rng.uniform(-400, 400, n), Q = rng.uniform(50, 250, n), rw = 0.2)
+    model.calc_clogging(2, 0.5)
+    xw, yw, Q, rw, xi = model.well_arrays()
+    x = np.concatenate((rng.uniform(0, 300, 2000), xw[:5], xw[5:10] + 0.1))
+    y = np.concatenate((rng.uniform(-500, 500, 2000), yw[:5], yw[5:10]))
+    return model, x, y
+
+
+def _assert_close(value, reference, rtol, name):
+    # maximum difference relative to the largest value of the reference
+    error = np.max(np.abs(value - reference))
+    bound = rtol*np.max(np.abs(reference))
+    assert error <= bound, "{}: error {:.3g} above {:.3g}".format(name, error, bound)
+
+
+def test_numba_kernels():
+    _needs_numba()
+    model, x, y = _wellfield()
+    xw, yw, Q, rw, xi = model.well_arrays()
+    numba_ = kernels_numba.NUMBA
+    for images in (xi, None):
+        wells = (xw, yw, Q, rw, images)
+        _assert_close(numba_.phi(x, y, *wells), kernels.NUMPY.phi(x, y, *wells), 1e-10, 'phi')
+        _assert_close(numba_.psi(x, y, *wells), kernels.NUMPY.psi(x, y, *wells), 1e-10, 'psi')
+        _assert_close(numba_.omega(x, y, *wells), kernels.NUMPY.omega(x, y, *wells), 1e-10, 'omega')
+        # (the discharge is singular at the well locations)
+        xd, yd = np.concatenate((x[:-10], x[-5:])), np.concatenate((y[:-10], y[-5:]))
+        for value, reference, name in zip(numba_.discharge(xd, yd, *wells), kernels.NUMPY.discharge(xd, yd, *wells),
+                                          ('Qx', 'Qy', 'phi (discharge)')):
+            _assert_close(value, reference, 1e-10, name)
+
+
+def test_numba_tracking():
+    _needs_numba()
+    times = []
+    for backend in ('numpy', 'numba'):
+        model = model_proposal.Model(k = 10, H = 20, h0 = 15, backend = backend)
+        model.Qo_x = -0.2
+        model_proposal.Well(model, Q = 800, rw = 0.2, x = 40, y = 0)
+        starts = (np.full(5, 0.1), np.linspace(-150, 150, 5))
+        times.append(solvers.river_length(model).time_travel(0.3, delta_s = 1.0, starts = starts)[0])
+    _assert_close(times[1], times[0], 1e-3, 'travel time')
+
+
+def test_farfield():
+    model, x, y = _wellfield(n = 600)
+    model.farfield_threshold = None
+    phi, psi = model.calc_phi(x, y), model.calc_psi(x, y)
+    model.farfield_threshold = 1
+    assert model.kernel().name == 'farfield'
+    for value, reference, name in ((model.calc_phi(x, y), phi, 'phi'), (model.calc_psi(x, y), psi, 'psi')):
+        error = np.max(np.abs(value - reference))
+        assert error <= model.farfield_tol, "{}: error {:.3g} above {:.3g}".format(name, error, model.farfield_tol)
+
+
+def test_reduced_precision():
+    model, x, y = _wellfield()
+    omega = model.calc_omega(x, y)
+    omega_r = model.calc_omega(x, y, dtype = np.float32)
+    assert omega_r.dtype == np.complex64
+    # 1e-6 of the total discharge, plus the rounding of the value
+    bound = 1e-6*np.sum(np.abs(model.wells.Q)) + np.finfo(np.float32).eps*np.abs(omega)
+    for value, reference, name in ((omega_r.real, omega.real, 'phi'), (omega_r.imag, omega.imag, 'psi')):
+        assert np.all(np.abs(value - reference) <= bound), "{}: error above the bound".format(name)
+
+
+if __name__ == '__main__':
+    for test in (test_numba_kernels, test_numba_tracking, test_farfield, test_reduced_precision):
+        try:
+            test()
+            print(test.__name__, 'ok')
+        except unittest.SkipTest as skip:
+            print(test.__name__, 'skipped:', skip)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Transient evaluation of the AEM-RBF model wells with the Theis solution.
+
+The wells of the model start pumping at t = 0 (or follow a schedule of rate steps) from the
+steady state without pumping (baseflow only). Each well and its river image contribute
+
+    phi(x, y, t) = -Q/(4 pi) [W(r**2 S/(4 T t)) - W(ri**2 S/(4 T t))]
+
+to the discharge potential, which tends to the steady well potential Q/(4 pi) log(r**2/ri**2) for
+long times. W is the Theis well function (exponential integral E1), served from a precomputed
+table (cubic Hermite interpolation in log(u) with the exact derivative -exp(-u), absolute error
+< 1e-11). T is the transmissivity k*min(h0, H) (linearized for unconfined aquifers) and S the
+storage coefficient of the model (Model.S; the specific yield for unconfined aquifers).
+
+Schedules of rate steps (e.g. influence.read_wel_flows) are superposed as a batched operation:
+the responses to all steps, times, points and wells are evaluated together with numpy
+broadcasting (in blocks of times to limit the memory).
+
+Stream depletion (TheisWells.stream_depletion) follows Glover and Balmer (1954): the change of
+the river flow induced by each well is Q erfc(sqrt(D**2 S/(4 T t))), D = d + p (distance to the
+river plus clogging factor). It is the depletion of the river by the pumping, not the river water
+pumped by the well: it does not depend on the baseflow and tends to Q for long times (the
+pumping is balanced by the river). The river-water fraction of the steady model, with the
+baseflow, is solvers.river_length.solve_river_length (contrib).
+
+Note: the initial state has no well term at the reference location, which matches the steady
+model when the reference location is on the river line (as after Model.calc_clogging).
+"""
+import numpy as np
+from scipy.special import erfc, exp1
+
+import kernels
+
+# Well function table: W(u) at log-spaced u (with the exact derivative dW/dlog(u) = -exp(-u))
+_LOG_U = np.linspace(np.log(1e-10), np.log(50.0), 4001)
+_W = exp1(np.exp(_LOG_U))
+_DW = -np.exp(-np.exp(_LOG_U))
+_EULER = 0.5772156649015329
+
+
+def well_function(u):
+    """
+    Theis well function W(u) = E1(u) from the lookup table.
+    Uses the series -gamma - log(u) + u below the table (u < 1e-10) and 0 above (u > 50).
+
+    Parameters
+    ----------
+    u: float or numpy array (u > 0).
+
+    Returns
+    -------
+    W(u): float or numpy array with the shape of u.
+
+    """
+    u = np.asarray(u, dtype = float)
+    log_u = np.log(u)
+    h = _LOG_U[1] - _LOG_U[0]
+    s = (np.clip(log_u, _LOG_U[0], _LOG_U[-1]) - _LOG_U[0])/h
+    i = np.minimum(s.astype(np.intp), _LOG_U.shape[0] - 2)
+    t = s - i
+    # cubic Hermite basis
+    t2, t3 = t*t, t*t*t
+    W = ((2*t3 - 3*t2 + 1)*_W[i] + (t3 - 2*t2 + t)*h*_DW[i] +
+         (-2*t3 + 3*t2)*_W[i + 1] + (t3 - t2)*h*_DW[i + 1])
+    W = np.where(log_u < _LOG_U[0], -_EULER - log_u + u, W)
+    W = np.where(log_u > _LOG_U[-1], 0.0, W)
+    return W[()]
+
+
+class TheisWells:
+    """
+    Transient (Theis) evaluation of the wells of a model, with their river images (wells only
+    without image river, model.images False).
+
+    Inputs:
+    --------------------------
+        model: AEM-RBF model with the storage coefficient S (model.S)
+        times: start times of the rate steps (1d array), None: the wells start at t = 0
+        Q: discharge rate of each well in each step (steps x wells), None: the model rates
+        block: maximum number of (time, step, point, well) values evaluated at once
+
+    Results at the times t (1d array) and points (x, y) (any broadcastable shape) have
+    shape (len(t),) + points shape.
+    """
+    def __init__(self, model, times = None, Q = None, block = 4000000):
+        if getattr(model, 'S', None) is None:
+            raise ValueError("Set the storage coefficient of the model (model.S) for transient evaluations")
+        if model.ensemble_shape != ():
+            raise ValueError("Transient evaluations do not support ensemble models")
+        if model.elements:
+            raise ValueError("Transient evaluations do not support models with elements other than wells")
+        if model.strip is not None:
+            raise ValueError("Transient evaluations do not support strip aquifers")
+        self.model = model
+        self.times = np.zeros(1) if times is None else np.asarray(times, dtype = float).ravel()
+        Q = np.broadcast_to(np.asarray(model.wells.Q if Q is None else Q, dtype = float),
+                            (self.times.shape[0], len(model.wells)))
+        self.Q = Q
+        # rate changes at the start of each step (superposition):
+        self.dQ = np.diff(Q, axis = 0, prepend = 0)
+        self.block = block
+        self.T = model.k*min(model.h0, model.H)
+        self.S = model.S
+
+    def _elapsed(self, t):
+        # time since the start of each step (times x steps), <= 0: step not started
+        return np.asarray(t, dtype = float).reshape(-1, 1) - self.times
+
+    def _unit_potential(self, r2, elapsed):
+        # -1/(4 pi) W(r2 S/(4 T dt)) for dt > 0, else 0; r2 (..., wells), elapsed (times, steps)
+        dt = elapsed[:, :, np.newaxis, np.newaxis]
+        started = dt > 0
+        u = r2*self.S/(4*self.T*np.where(started, dt, 1))
+        return np.where(started, -well_function(u)/(4*np.pi), 0)
+
+    def phi(self, x, y, t):
+        """
+        Discharge potential at the points (x, y) and times t.
+        """
+        m = self.model
+        x, y = np.broadcast_arrays(np.asarray(x, dtype = float), np.asarray(y, dtype = float))
+        shape = x.shape
+        xp, yp = x.reshape(-1, 1), y.reshape(-1, 1)
+        xw, yw, Q, rw, xi = m.well_arrays()
+        r2 = np.maximum((xp - xw)**2 + (yp - yw)**2, rw**2)
+        ri2 = None if xi is None else (xp - xi)**2 + (yp - yw)**2 # (None: no image river)
+        elapsed = self._elapsed(t)
+        out = np.empty((elapsed.shape[0], xp.shape[0]))
+        # times per block:
+        n = max(1, self.block//max(1, elapsed.shape[1]*r2.size))
+        for i in range(0, elapsed.shape[0], n):
+            e = elapsed[i:i + n]
+            unit = self._unit_potential(r2, e)
+            if ri2 is not None:
+                unit = unit - self._unit_potential(ri2, e)
+            out[i:i + n] = np.einsum('tspn,sn->tp', unit, self.dQ)
+        # initial state (baseflow only, phi_c at the reference location):
+        out += m.phi_c + m.Qo_x*m.x - m.Qo_x*xp[:, 0]
+        return out.reshape((elapsed.shape[0],) + shape)
+
+    def head(self, x, y, t):
+        """
+        Heads at the points (x, y) and times t.
+        """
+        return kernels.head_from_phi(self.phi(x, y, t), self.model.k, self.model.H)
+
+    def drawdown(self, x, y, t):
+        """
+        Drawdown (head without pumping minus head) at the points (x, y) and times t.
+        """
+        m = self.model
+        x = np.broadcast_arrays(np.asarray(x, dtype = float), np.asarray(y, dtype = float))[0]
+        h_initial = kernels.head_from_phi(m.phi_c + m.Qo_x*m.x - m.Qo_x*x, m.k, m.H)
+        return h_initial - self.head(x, y, t)
+
+    def stream_depletion(self, t):
+        """
+        Stream depletion of each well (Glover and Balmer) at times t: the reduction of the river
+        flow (increase of the inflow to the aquifer) caused by the pumping, independent of the
+        baseflow (see the module docstring).
+
+        Returns
+        -------
+        numpy array (times x wells).
+
+        """
+        m = self.model
+        if not m.images:
+            raise ValueError("Stream depletion needs the image river (model.images = True)")
+        d, xi, yi = m.image_geometry()
+        D = d + m.p
+        elapsed = self._elapsed(t)[:, :, np.newaxis]
+        started = elapsed > 0
+        fraction = np.where(started, erfc(np.sqrt(D**2*self.S/(4*self.T*np.where(started, elapsed, 1)))), 0)
+        return np.einsum('tsn,sn->tn', fraction, self.dQ)
+
+    def depletion_fraction(self, t):
+        """
+        Stream depletion of all the wells as a fraction of the total pumping rate at times t (1d array).
+        """
+        depletion = self.stream_depletion(t).sum(axis = 1)
+        steps = np.searchsorted(self.times, np.asarray(t, dtype = float).ravel(), side = 'left') - 1
+        total = np.where(steps >= 0, self.Q[np.maximum(steps, 0)].sum(axis = 1), 0)
+        return np.divide(depletion, total, out = np.full(depletion.shape, np.nan), where = total != 0)